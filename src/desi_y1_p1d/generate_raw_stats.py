@@ -1,5 +1,10 @@
 import argparse
-import struct
+import functools
+import hashlib
+import itertools
+import os
+import time
+import tracemalloc
 
 import numpy as np
 import fitsio
@@ -17,59 +22,342 @@ def turner24_mf(z):
     return np.exp(-2.46e-3 * (1 + z)**3.62)
 
 
-def readTrueP1D(fname):
-    print("I am reading true power.", flush=True)
-    file = open(fname, 'rb')
+MEANFLUX_FUNCTIONS = {
+    'mock': TRUE_MEAN_FLUX, 'becker13': becker13_mf, 'turner24': turner24_mf
+}
 
-    nk, nz = struct.unpack('ii', file.read(struct.calcsize('ii')))
 
-    fmt = 'd' * nz
-    data = file.read(struct.calcsize(fmt))
-    z = np.array(struct.unpack(fmt, data), dtype=np.double)
+def _getCacheDir():
+    cache_dir = os.environ.get(
+        "XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(cache_dir, "desi_y1_p1d")
 
-    fmt = 'd' * nk
-    data = file.read(struct.calcsize(fmt))
-    k = np.array(struct.unpack(fmt, data), dtype=np.double)
 
-    fmt = 'd' * nk * nz
-    data = file.read(struct.calcsize(fmt))
-    p1d = np.array(struct.unpack(fmt, data), dtype=np.double).reshape((nz, nk))
+def _readTruePowerBinary(fname):
+    # Layout: int32 nk, int32 nz, nz doubles z, nk doubles k,
+    # nz * nk doubles P1D in C order.
+    header = np.fromfile(fname, dtype=np.int32, count=2)
+    if header.size != 2:
+        raise ValueError(f"{fname} is too short to be a true power file.")
 
-    return RegularGridInterpolator((z, k), p1d)
+    nk, nz = int(header[0]), int(header[1])
+    if nk < 2 or nz < 2:
+        raise ValueError(f"Invalid grid size nk={nk}, nz={nz} in {fname}.")
 
+    offset = header.nbytes
+    expected_size = offset + 8 * (nz + nk + nz * nk)
+    fsize = os.path.getsize(fname)
+    if fsize != expected_size:
+        raise ValueError(
+            f"{fname} has {fsize} bytes, but nk={nk}, nz={nz} "
+            f"requires {expected_size} bytes.")
 
-def get_true_var_lss(
-        z, dv, truepower_interp2d,
-        lnk1=-4 * np.log(10), lnk2=-0.5 * np.log(10), dlnk=0.01
+    data = np.memmap(fname, dtype=np.float64, mode='r', offset=offset)
+    z = data[:nz]
+    k = data[nz:nz + nk]
+    p1d = data[nz + nk:].reshape(nz, nk)
+
+    if np.any(np.diff(z) <= 0) or np.any(np.diff(k) <= 0) or k[0] <= 0:
+        raise ValueError(f"z and k grids in {fname} are not increasing.")
+
+    return z, k, p1d
+
+
+@functools.lru_cache(maxsize=8)
+def _readTruePowerGridCached(fname, fsize, mtime_ns, use_cache):
+    if not use_cache:
+        return _readTruePowerBinary(fname)
+
+    key = hashlib.sha1(
+        repr((fname, fsize, mtime_ns)).encode()).hexdigest()[:16]
+    fcache = os.path.join(_getCacheDir(), f"true-power-{key}.npz")
+    if os.path.exists(fcache):
+        with np.load(fcache) as cached:
+            return cached['z'], cached['k'], cached['p1d']
+
+    z, k, p1d = _readTruePowerBinary(fname)
+    try:
+        os.makedirs(_getCacheDir(), exist_ok=True)
+        ftmp = f"{fcache}.{os.getpid()}.tmp.npz"
+        np.savez(ftmp, z=z, k=k, p1d=p1d)
+        os.replace(ftmp, fcache)
+    except OSError as e:
+        print(f"Could not cache true power grid: {e}", flush=True)
+
+    return z, k, p1d
+
+
+def readTruePowerGrid(fname, use_cache=False):
+    """Reads the binary true power file into z, k and P1D(z, k) arrays.
+
+    Grids are read-only memory maps of the file and are memoized in memory
+    by absolute path, size and modification time. Set use_cache=True to
+    also keep an .npz copy in the user cache directory, e.g. if fname is on
+    a slow file system.
+    """
+    fname = os.path.abspath(fname)
+    st = os.stat(fname)
+    return _readTruePowerGridCached(
+        fname, st.st_size, st.st_mtime_ns, use_cache)
+
+
+class TruePowerInterpolator():
+    """Bilinear interpolation of P1D(z, k) on the true power grid.
+
+    Called like RegularGridInterpolator with a tuple (z, k) of broadcastable
+    arrays. Bin indices and weights are found on the z and k arrays before
+    broadcasting, directly from the grid spacing when z is uniform and k is
+    log-uniform. Results agree with RegularGridInterpolator up to floating
+    point rounding. Use --benchmark-interp to time both.
+    """
+
+    @staticmethod
+    def _isUniform(x):
+        dx = np.diff(x)
+        return np.allclose(dx, dx[0], rtol=1e-8, atol=0)
+
+    def __init__(self, z, k, p1d):
+        self.z = np.asarray(z, dtype=float)
+        self.k = np.asarray(k, dtype=float)
+        self.p1d = np.ascontiguousarray(p1d, dtype=float)
+        self.lnk = np.log(self.k)
+        self.uniform_z = self._isUniform(self.z)
+        self.uniform_lnk = self._isUniform(self.lnk)
+        self.dz = (self.z[-1] - self.z[0]) / (self.z.size - 1)
+        self.dlnk = (self.lnk[-1] - self.lnk[0]) / (self.k.size - 1)
+
+    @staticmethod
+    def _locate(x, grid, fgrid, fx, dfx, uniform, dim):
+        x = np.asarray(x, dtype=float)
+        if np.any(x < grid[0]) or np.any(x > grid[-1]):
+            raise ValueError(
+                f"One of the requested xi is out of bounds in dimension {dim}")
+
+        n = grid.size
+        if uniform:
+            i = np.floor((fx - fgrid[0]) / dfx).astype(int)
+            i = np.clip(i, 0, n - 2)
+            # Fix rounding at bin edges
+            i -= (x < grid[i]) & (i > 0)
+            i += (x >= grid[i + 1]) & (i < n - 2)
+        else:
+            i = np.clip(np.searchsorted(grid, x, side='right') - 1, 0, n - 2)
+
+        t = (x - grid[i]) / (grid[i + 1] - grid[i])
+        return i, t
+
+    def __call__(self, xi):
+        z, k = xi
+        iz, tz = self._locate(
+            z, self.z, self.z, z, self.dz, self.uniform_z, 0)
+        ik, tk = self._locate(
+            k, self.k, self.lnk, np.log(k), self.dlnk, self.uniform_lnk, 1)
+
+        p = self.p1d
+        if np.ndim(z) == 1 and np.ndim(k) == 2 and np.shape(k)[1] == 1:
+            # Outer product query as in get_true_var_lss: interpolate the
+            # few grid redshifts in k first, then gather along z.
+            pk = (1 - tk) * p[:, ik[:, 0]].T + tk * p[:, ik[:, 0] + 1].T
+            return (1 - tz) * pk[:, iz] + tz * pk[:, iz + 1]
+
+        return ((1 - tz) * ((1 - tk) * p[iz, ik] + tk * p[iz, ik + 1])
+                + tz * ((1 - tk) * p[iz + 1, ik] + tk * p[iz + 1, ik + 1]))
+
+
+@functools.lru_cache(maxsize=8)
+def _getTruePowerInterp(fname, fsize, mtime_ns, use_cache):
+    return TruePowerInterpolator(*readTruePowerGrid(fname, use_cache))
+
+
+def readTrueP1D(fname, use_cache=False):
+    print("I am reading true power.", flush=True)
+    fname = os.path.abspath(fname)
+    st = os.stat(fname)
+    return _getTruePowerInterp(
+        fname, st.st_size, st.st_mtime_ns, use_cache)
+
+
+def benchmark_interpolators(
+        fname, nz=3750, nk=351, nrepeat=5, use_cache=False
 ):
-    print("I am calculation var_lss.", flush=True)
-    R_kms = dv
+    z, k, p1d = readTruePowerGrid(fname, use_cache)
+    rgi = RegularGridInterpolator((z, k), p1d)
+    fast = TruePowerInterpolator(z, k, p1d)
 
-    Nkpoints = int((lnk2 - lnk1) / dlnk) + 1
-    k = np.exp(np.linspace(lnk1, lnk2, Nkpoints))[:, np.newaxis]
+    zq = np.linspace(max(z[0], 1.9), min(z[-1], 4.5), nz)
+    kq = np.exp(np.linspace(
+        max(np.log(k[0]), -4 * np.log(10)), min(np.log(k[-1]), -0.5 * np.log(10)),
+        nk))[:, np.newaxis]
 
-    window_fn_2 = np.sinc(k * dv / 2 / np.pi)**2 * np.exp(-k**2 * R_kms**2)
-    print(window_fn_2.shape)
+    timings = {}
+    for name, interp in [("RegularGridInterpolator", rgi),
+                         ("TruePowerInterpolator", fast)]:
+        t0 = time.perf_counter()
+        for _ in range(nrepeat):
+            result = interp((zq, kq))
+        timings[name] = (time.perf_counter() - t0) / nrepeat
+        print(f"{name}: {timings[name] * 1e3:.1f} ms per "
+              f"({nk}, {nz}) query.", flush=True)
 
-    var_lss = np.empty(z.size)
+    expected = rgi((zq, kq))
+    max_rel_diff = np.max(np.abs(result - expected) / np.abs(expected))
+    speedup = timings["RegularGridInterpolator"] / timings["TruePowerInterpolator"]
+    print(f"Speedup: {speedup:.1f}x. Max relative difference: "
+          f"{max_rel_diff:.1e}.", flush=True)
+
+    return speedup, max_rel_diff
+
+
+def _var_lss_integrand(lnk, z, dv, truepower_interp2d):
+    k = np.exp(lnk)[:, np.newaxis]
+    window_fn_2 = np.sinc(k * dv / 2 / np.pi)**2 * np.exp(-k**2 * dv**2)
     tp2 = truepower_interp2d((z, k))
     tp2 *= k * window_fn_2 / np.pi
+    return tp2
+
+
+def _get_lnk_grid(lnk1, lnk2, dlnk):
+    # Both var_lss paths integrate on this grid with the trapezoid rule. The
+    # spacing is (lnk2 - lnk1) / (nk - 1), which is close to but not exactly
+    # dlnk, so the limits are always included.
+    nk = int((lnk2 - lnk1) / dlnk) + 1
+    return np.linspace(lnk1, lnk2, nk), (lnk2 - lnk1) / (nk - 1)
+
+
+def _trapezoid_weights(nk, h):
+    weights = np.full(nk, h)
+    weights[[0, -1]] /= 2
+    return weights
+
+
+def _sum_integrand_blocks(lnk, z, dv, truepower_interp2d, kblock, weights):
+    # sum_i weights_i f(lnk_i) without holding more than kblock k-rows.
+    result = np.zeros(z.size)
+    for i in range(0, lnk.size, kblock):
+        f = _var_lss_integrand(lnk[i:i + kblock], z, dv, truepower_interp2d)
+        result += weights[i:i + kblock] @ f
+    return result
+
+
+def _get_true_var_lss_bounded(
+        z, dv, truepower_interp2d, lnk1, lnk2, dlnk, rtol, max_memory_mb,
+        max_refine=8
+):
+    # Trapezoid rule on nested k grids, starting from the grid of the dense
+    # path. Every refinement only evaluates the new midpoints. The result is
+    # the Richardson extrapolation T_{h/2} + (T_{h/2} - T_h) / 3, and
+    # |T_{h/2} - T_h| / 3, the error of T_{h/2}, bounds its error. Work is
+    # chunked over z and k so that the integrand never uses more than
+    # max_memory_mb.
+    lnk0, h0 = _get_lnk_grid(lnk1, lnk2, dlnk)
+    nk0 = lnk0.size
+    # Interpolator and window temporaries take ~16 doubles per element.
+    nelem = max(1, int(max_memory_mb * 2**20 / (8 * 16)))
+    zchunk = min(z.size, max(1, nelem // nk0))
+    kblock = max(1, nelem // zchunk)
+
+    dv = np.broadcast_to(dv, z.shape)
+    var_lss = np.empty(z.size)
+    rel_err = np.zeros(z.size)
+    nlevels = 0
+
+    tracemalloc.start()
+    for j1 in range(0, z.size, zchunk):
+        zc, dvc = z[j1:j1 + zchunk], dv[j1:j1 + zchunk]
+        T = _sum_integrand_blocks(
+            lnk0, zc, dvc, truepower_interp2d, kblock,
+            _trapezoid_weights(nk0, h0))
+        h, npts = h0, nk0
+        err = np.full(zc.size, np.inf)
+        correction = np.zeros(zc.size)
+
+        for level in range(1, max_refine + 1):
+            mids = lnk1 + h * (np.arange(npts - 1) + 0.5)
+            T_new = T / 2 + _sum_integrand_blocks(
+                mids, zc, dvc, truepower_interp2d, kblock,
+                np.full(mids.size, h / 2))
+            correction = (T_new - T) / 3
+            err = np.abs(correction) / np.maximum(np.abs(T_new), 1e-300)
+            T, h, npts = T_new, h / 2, 2 * npts - 1
+            nlevels = max(nlevels, level)
+            if rtol is None or err.max() < rtol:
+                break
+
+        var_lss[j1:j1 + zchunk] = T + correction
+        rel_err[j1:j1 + zchunk] = err
+
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"var_lss: {z.size} pixels in chunks of {zchunk}, k blocks of "
+          f"{kblock}, {nlevels} refinement levels. Max relative error "
+          f"estimate {rel_err.max():.2e}. Peak traced memory "
+          f"{peak / 2**20:.1f} MB.", flush=True)
+    if rtol is not None and rel_err.max() >= rtol:
+        print(f"WARNING: var_lss did not reach rtol={rtol:.1e} within "
+              f"{max_refine} refinements.", flush=True)
+
+    return var_lss
+
+
+def get_true_var_lss(
+        z, dv, truepower_interp2d,
+        lnk1=-4 * np.log(10), lnk2=-0.5 * np.log(10), dlnk=0.01,
+        rtol=None, max_memory_mb=None
+):
+    print("I am calculation var_lss.", flush=True)
+    if rtol is not None or max_memory_mb is not None:
+        if max_memory_mb is None:
+            max_memory_mb = 256.
+        return _get_true_var_lss_bounded(
+            z, dv, truepower_interp2d, lnk1, lnk2, dlnk, rtol, max_memory_mb)
+
+    # Same discretization as the first level of the bounded path
+    lnk, h = _get_lnk_grid(lnk1, lnk2, dlnk)
+    tp2 = _var_lss_integrand(lnk, z, dv, truepower_interp2d)
     print(tp2.shape, z.shape)
-    var_lss = np.trapz(tp2, dx=dlnk, axis=0)
+    var_lss = _trapezoid_weights(lnk.size, h) @ tp2
 
     return var_lss
 
 
+def _getWaveGrid(w1, w2, dlambda):
+    num_bins = int((w2 - w1) / dlambda) + 1
+    return np.linspace(w1, w2, num_bins)
+
+
+def get_true_var_lss_batch(
+        wave_grids, dlambdas, truepower_interp2d, **var_lss_kwargs
+):
+    # var_lss is evaluated pixel by pixel from (wave, dlambda), so pixels
+    # shared between configurations are integrated once in a single call.
+    sizes = [wave.size for wave in wave_grids]
+    pixels = np.column_stack((
+        np.concatenate(wave_grids),
+        np.concatenate([np.full(n, dl) for n, dl in zip(sizes, dlambdas)])
+    ))
+    pixels, inv = np.unique(pixels, axis=0, return_inverse=True)
+    print(f"Evaluating var_lss on {pixels.shape[0]} unique pixels for "
+          f"{len(wave_grids)} configurations.", flush=True)
+
+    wave, dlambda = pixels.T
+    var_lss = get_true_var_lss(
+        wave / fid.LYA_WAVELENGTH - 1, fid.LIGHT_SPEED * dlambda / wave,
+        truepower_interp2d, **var_lss_kwargs)
+
+    return np.split(var_lss[inv.ravel()], np.cumsum(sizes)[:-1])
+
+
 def make_up_raw_file(
         fname_out, truepower_interp2d, meanflux_fn,
-        w1, w2, rfw1, rfw2, dlambda, dloglam=3e-4
+        w1, w2, rfw1, rfw2, dlambda, dloglam=3e-4, var_lss=None
 ):
-    num_bins = int((w2 - w1) / dlambda) + 1
-    wave = np.linspace(w1, w2, num_bins)
+    wave = _getWaveGrid(w1, w2, dlambda)
     z = wave / fid.LYA_WAVELENGTH - 1
     true_mean = meanflux_fn(z)
-    var_lss = get_true_var_lss(
-        z, fid.LIGHT_SPEED * dlambda / wave, truepower_interp2d)
+    if var_lss is None:
+        var_lss = get_true_var_lss(
+            z, fid.LIGHT_SPEED * dlambda / wave, truepower_interp2d)
     flux_variance = var_lss * true_mean**2
     # Unused in p1d analysis
     stack_weight = np.ones_like(wave)
@@ -90,9 +378,40 @@ def make_up_raw_file(
     results.close()
 
 
+def make_up_raw_files(
+        out_fname_base, truepower_interp2d, configs, **var_lss_kwargs
+):
+    """Writes one raw stats file per configuration in one process.
+
+    configs is a list of (w1, w2, rfw1, rfw2, dlambda, meanflux) tuples,
+    where meanflux is a key of MEANFLUX_FUNCTIONS. Keyword arguments are
+    passed to get_true_var_lss.
+    """
+    add_meanflux_suffix = len(set(c[-1] for c in configs)) > 1
+    all_var_lss = get_true_var_lss_batch(
+        [_getWaveGrid(c[0], c[1], c[4]) for c in configs],
+        [c[4] for c in configs], truepower_interp2d, **var_lss_kwargs)
+
+    for (w1, w2, rfw1, rfw2, dlambda, meanflux), var_lss in zip(
+            configs, all_var_lss):
+        fname_out = (f"{out_fname_base}-obs{w1:.0f}-{w2:.0f}"
+                     f"-rf{rfw1:.0f}-{rfw2:.0f}-dw{dlambda:.1f}")
+        if add_meanflux_suffix:
+            fname_out += f"-{meanflux}"
+        fname_out += ".fits"
+
+        make_up_raw_file(
+            fname_out, truepower_interp2d, MEANFLUX_FUNCTIONS[meanflux],
+            w1, w2, rfw1, rfw2, dlambda, var_lss=var_lss)
+        print(f"Saved {fname_out}.", flush=True)
+
+
 def main():
     parser = argparse.ArgumentParser(
-        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description=(
+            "Options that accept multiple values are expanded into a grid. "
+            "One file is written for every combination."))
     parser.add_argument(
         "--fname-true-power", help="True power file",
         default=("/global/cfs/cdirs/desicollab/users/"
@@ -102,41 +421,59 @@ def main():
         "--out-fname-base", help="Output filename",
         default="ohio-p1d-true-stats")
     parser.add_argument(
-        '--lambda-min', type=float, default=3600., required=False,
+        '--lambda-min', type=float, default=[3600.], nargs='+',
         help='Lower limit on observed wavelength [Angstrom]')
     parser.add_argument(
-        '--lambda-max', type=float, default=6600., required=False,
+        '--lambda-max', type=float, default=[6600.], nargs='+',
         help='Upper limit on observed wavelength [Angstrom]')
     parser.add_argument(
-        '--lambda-rest-min', type=float, default=1050., required=False,
+        '--lambda-rest-min', type=float, default=[1050.], nargs='+',
         help='Lower limit on rest frame wavelength [Angstrom]')
     parser.add_argument(
-        '--lambda-rest-max', type=float, default=1180., required=False,
+        '--lambda-rest-max', type=float, default=[1180.], nargs='+',
         help='Upper limit on rest frame wavelength [Angstrom]')
     parser.add_argument(
-        '--delta-lambda', type=float, default=0.8, required=False,
+        '--delta-lambda', type=float, default=[0.8], nargs='+',
         help='Size of the rebined pixels in lambda')
     parser.add_argument(
-        "--meanflux", choices=['mock', 'becker13', 'turner24'], default='mock',
-        help='Mean flux to use.')
+        "--meanflux", choices=list(MEANFLUX_FUNCTIONS), default=['mock'],
+        nargs='+', help='Mean flux to use.')
+    parser.add_argument(
+        "--rtol", type=float, default=None,
+        help="Refine the k grid until the relative error estimate of var_lss "
+             "is below this tolerance.")
+    parser.add_argument(
+        "--max-memory-mb", type=float, default=None,
+        help="Integrate var_lss in z and k chunks using at most this much "
+             "memory for the integrand. Default with --rtol: 256 MB.")
+    parser.add_argument(
+        "--cache-true-power", action="store_true",
+        help="Keep an .npz copy of the true power grid in the user cache "
+             "directory instead of only memory mapping the file.")
+    parser.add_argument(
+        "--benchmark-interp", action="store_true",
+        help="Compare TruePowerInterpolator against RegularGridInterpolator "
+             "on the true power file and exit.")
     args = parser.parse_args()
 
-    fname_out = (f"{args.out_fname_base}-obs{args.lambda_min:.0f}"
-                 f"-{args.lambda_max:.0f}-rf{args.lambda_rest_min:.0f}"
-                 f"-{args.lambda_rest_max:.0f}-dw{args.delta_lambda:.1f}.fits")
-
-    if args.meanflux == 'mock':
-        meanflux_fn = TRUE_MEAN_FLUX
-    elif args.meanflux == 'becker13':
-        meanflux_fn = becker13_mf
-    elif args.meanflux == 'turner24':
-        meanflux_fn = turner24_mf
-    else:
-        raise Exception("Unknown mean flux option")
-
-    truepower_interp2d = readTrueP1D(args.fname_true_power)
-
-    make_up_raw_file(fname_out, truepower_interp2d, meanflux_fn,
-                     args.lambda_min, args.lambda_max,
-                     args.lambda_rest_min, args.lambda_rest_max,
-                     args.delta_lambda)
+    if args.benchmark_interp:
+        benchmark_interpolators(
+            args.fname_true_power, use_cache=args.cache_true_power)
+        return
+
+    configs = [
+        c for c in itertools.product(
+            args.lambda_min, args.lambda_max,
+            args.lambda_rest_min, args.lambda_rest_max,
+            args.delta_lambda, args.meanflux)
+        if c[0] < c[1] and c[2] < c[3]
+    ]
+    if not configs:
+        raise Exception("No valid configuration in the grid.")
+
+    truepower_interp2d = readTrueP1D(
+        args.fname_true_power, args.cache_true_power)
+
+    make_up_raw_files(
+        args.out_fname_base, truepower_interp2d, configs,
+        rtol=args.rtol, max_memory_mb=args.max_memory_mb)
@@ -1,7 +1,13 @@
 import argparse
+from collections import OrderedDict
+import hashlib
 import logging
 from multiprocessing import Pool
+import os
 from os import makedirs as os_makedirs
+import shutil
+import tempfile
+import time
 
 import numpy as np
 import fitsio
@@ -10,6 +16,8 @@ import qsotools.fiducial as fid
 from qsotools.mocklib import lognMeanFluxGH as TRUE_MEAN_FLUX
 from qsotools.specops import fitGaussian2RMat
 
+from desi_y1_p1d import utils
+
 
 def createEdgesFromCenters(wave_centers):
     npix = len(wave_centers)
@@ -45,15 +53,287 @@ def getForestAnalysisRegion(wave, z_qso, args):
     return lya_ind
 
 
-def saveDelta(
-        thid, wave, delta, ivar, cont, meanf, z_qso, ra, dec, rmat, fdelta
+def getForestWindow(args):
+    # Observed wavelength range any forest can fall in
+    w1 = max(fid.LYA_WAVELENGTH * (1 + args.z_forest_min), args.desi_w1)
+    w2 = min(fid.LYA_WAVELENGTH * (1 + args.z_forest_max), args.desi_w2)
+    return w1, w2
+
+
+def getForestBounds(wave, z_qso, args):
+    """Vectorized getForestAnalysisRegion for many quasars.
+
+    Returns:
+        i1, i2 (ndarray): wave[i1[n]:i2[n]] is the forest of quasar n.
+    """
+    w1, w2 = getForestWindow(args)
+    w1 = np.maximum(w1, fid.LYA_FIRST_WVL * (1 + z_qso))
+    w2 = np.minimum(w2, fid.LYA_LAST_WVL * (1 + z_qso))
+    i1 = np.searchsorted(wave, w1)
+    i2 = np.maximum(np.searchsorted(wave, w2), i1)
+
+    return i1, i2
+
+
+def getShortForests(z_qso, dlambda, npixels, skip):
+    # Forests with fewer pixels than skip times the full forest length
+    max_no_pixels = (
+        (fid.LYA_LAST_WVL - fid.LYA_FIRST_WVL) * (1 + z_qso) / dlambda
+    ).astype(int)
+    return npixels < max_no_pixels * skip
+
+
+class InterpWeights():
+    """Precomputed linear interpolation from grid xp onto x.
+
+    Same as np.interp(x, xp, fp) for every row of fp, including the
+    clamping outside xp, without searching xp again for each row.
+    """
+
+    def __init__(self, x, xp):
+        self.j = np.clip(
+            np.searchsorted(xp, x, side='right') - 1, 0, xp.size - 2)
+        self.dx = np.clip(x, xp[0], xp[-1]) - xp[self.j]
+        self.dxp = xp[self.j + 1] - xp[self.j]
+
+    def getColumns(self, k1, k2):
+        """Columns of fp needed to interpolate onto x[k1:k2]."""
+        return self.j[k1], self.j[k2 - 1] + 2
+
+    def __call__(self, fp, k1, k2, jlo=0):
+        # fp holds columns jlo onwards of the full grid.
+        j = self.j[k1:k2] - jlo
+        f0 = fp[..., j]
+        slope = (fp[..., j + 1] - f0) / self.dxp[k1:k2]
+        return slope * self.dx[k1:k2] + f0
+
+
+def iterForestDeltas(
+        wave, flux, ivar, rows, truth_interp, truth_flux, truth_rows,
+        i1, i2, dtype=np.float64, mask_bad_cont=True, batch_size=256
 ):
+    """Yields delta, ivar, continuum and mean flux of forests in order.
+
+    All quasars share the wavelength grid. The mean flux is evaluated once
+    on the full grid. Continua are interpolated from truth with
+    precomputed weights, one batch of quasars at a time, and the yielded
+    arrays are views of batch arrays.
+
+    Args:
+        wave (ndarray): Shared wavelength grid.
+        flux (ndarray): Spectra on wave, one per row.
+        ivar (ndarray or float): Inverse variance of flux.
+        rows (ndarray): Rows of flux and ivar to use.
+        truth_interp (InterpWeights): From truth wave grid onto wave.
+        truth_flux (ndarray): Truth continua, one per row.
+        truth_rows (ndarray): Rows of truth_flux for rows.
+        i1, i2 (ndarray): Forest bounds for rows.
+        dtype (type): Precision of the output.
+        mask_bad_cont (bool): Set delta and ivar to 0 where the continuum
+            is not positive.
+        batch_size (int): Quasars per batch.
+    """
+    tr_mf_full = TRUE_MEAN_FLUX(wave / fid.LYA_WAVELENGTH - 1).astype(dtype)
+
+    for b1 in range(0, rows.size, batch_size):
+        s = slice(b1, b1 + batch_size)
+        k1, k2 = i1[s].min(), i2[s].max()
+
+        jlo, jhi = truth_interp.getColumns(k1, k2)
+        cont = truth_interp(
+            truth_flux[truth_rows[s], jlo:jhi], k1, k2, jlo).astype(dtype)
+
+        tr_mf = tr_mf_full[k1:k2]
+        delta = flux[rows[s], k1:k2].astype(dtype) / cont
+        if np.ndim(ivar) == 0:
+            ivar_b = ivar * cont**2
+        else:
+            ivar_b = ivar[rows[s], k1:k2].astype(dtype) * cont**2
+
+        # Make it delta
+        delta = delta / tr_mf - 1
+        ivar_b = ivar_b * tr_mf**2
+        if mask_bad_cont:
+            w = cont <= 0
+            delta[w] = 0
+            ivar_b[w] = 0
+
+        for n in range(delta.shape[0]):
+            f = slice(i1[b1 + n] - k1, i2[b1 + n] - k1)
+            yield delta[n, f], ivar_b[n, f], cont[n, f], tr_mf[f]
+
+
+def getMeanResolutionProfiles(reso, rows, i1, i2):
+    """Resolution matrices averaged over forest pixels.
+
+    Uses prefix sums along wavelength, so all forests of a file are done
+    at once.
+
+    Returns:
+        profiles (ndarray): (nforests, ndiags) mean of reso[rows[n]] over
+            columns i1[n]:i2[n].
+    """
+    nrows, ndiags, _ = reso.shape
+    k1, k2 = i1.min(), i2.max()
+    csum = np.zeros((rows.size, ndiags, k2 - k1 + 1))
+    np.cumsum(reso[rows, :, k1:k2], axis=2, out=csum[:, :, 1:])
+    n = np.arange(rows.size)
+    profiles = csum[n, :, i2 - k1] - csum[n, :, i1 - k1]
+    return profiles / (i2 - i1)[:, None]
+
+
+def estimateResolutionWidths(profiles, dv):
+    """Moment estimate of Gaussian resolution widths.
+
+    Non-Gaussian wings bias this high compared to a fit, so it is only used
+    to start fitResolutionProfiles.
+
+    Args:
+        profiles (ndarray): (n, ndiags) mean resolution profiles.
+        dv (ndarray): Pixel size in km/s.
+
+    Returns:
+        R_kms (ndarray): One sigma width in km/s.
+    """
+    ndiags = profiles.shape[1]
+    x = np.arange(ndiags) - ndiags // 2
+    norm = profiles.sum(axis=1)
+    mean = profiles @ x / norm
+    var = profiles @ x**2 / norm - mean**2
+    return np.sqrt(np.clip(var, 0, None)) * dv
+
+
+def fitResolutionProfiles(profiles, dv, maxiter=50, rtol=1e-10):
+    """Least-squares Gaussian widths of many resolution profiles at once.
+
+    Fits the same model as fitGaussian2RMat, a normalized Gaussian
+    exp(-x^2 / 2R^2) dv / (sqrt(2 pi) R) sampled at x = j dv, with
+    Gauss-Newton steps for all profiles together. Steps start from the
+    moment estimate and are kept within (0, ndiags dv] like the bounds of
+    the fit.
+
+    Args:
+        profiles (ndarray): (n, ndiags) mean resolution profiles.
+        dv (ndarray): Pixel size in km/s.
+        maxiter (int): Maximum number of iterations.
+        rtol (float): Relative step size to stop.
+
+    Returns:
+        R_kms (ndarray): One sigma width in km/s.
+    """
+    ndiags = profiles.shape[1]
+    dv = np.broadcast_to(dv, profiles.shape[:1])
+    x = (np.arange(ndiags) - ndiags // 2) * dv[:, None]
+    rmax = ndiags * dv
+    R = np.clip(estimateResolutionWidths(profiles, dv), 1e-3 * dv, rmax)
+
+    for _ in range(maxiter):
+        u = (x / R[:, None])**2
+        model = np.exp(-u / 2) * (dv / R / np.sqrt(2 * np.pi))[:, None]
+        jac = model * (u - 1) / R[:, None]
+        step = -np.sum((model - profiles) * jac, axis=1) / np.sum(
+            jac**2, axis=1)
+        # Halve steps that would leave the bounds
+        R_new = R + step
+        R_new = np.where(R_new <= 0, R / 2, np.minimum(R_new, rmax))
+        done = np.abs(R_new - R) <= rtol * R
+        R = R_new
+        if done.all():
+            break
+
+    return R
+
+
+class ResolutionFitCache():
+    """Bounded LRU memo of fitGaussian2RMat results.
+
+    Keys are hashes of the banded matrix rounded to ``decimals`` and of its
+    wavelength range, so fibers with near-identical resolution share a fit.
+    """
+
+    def __init__(self, maxsize=4096, decimals=5):
+        self.maxsize = maxsize
+        self.decimals = decimals
+        self.memo = OrderedDict()
+        self.nhits = 0
+        self.nmisses = 0
+
+    def _key(self, wave, rmat):
+        h = hashlib.sha1(np.round(rmat, self.decimals).tobytes())
+        h.update(np.round([wave[0], wave[-1], wave.size], 3).tobytes())
+        return h.digest()
+
+    def __call__(self, thid, wave, rmat):
+        key = self._key(wave, rmat)
+        if key in self.memo:
+            self.memo.move_to_end(key)
+            self.nhits += 1
+            return self.memo[key]
+
+        self.nmisses += 1
+        R_kms = fitGaussian2RMat(thid, wave, rmat)
+        self.memo[key] = R_kms
+        if len(self.memo) > self.maxsize:
+            self.memo.popitem(last=False)
+        return R_kms
+
+
+_RESOLUTION_FIT_CACHE = None
+
+
+def _getResolutionFitCache(maxsize):
+    # One memo per process, so it lasts across the files of a worker.
+    global _RESOLUTION_FIT_CACHE
+    if _RESOLUTION_FIT_CACHE is None:
+        _RESOLUTION_FIT_CACHE = ResolutionFitCache(maxsize)
+    return _RESOLUTION_FIT_CACHE
+
+
+def fitResolutionWidths(
+        wave, reso, rows, i1, i2, thids=None, fit_cache=None
+):
+    """MEANRESO of every forest of a file in km/s.
+
+    If fit_cache is a ResolutionFitCache, every forest is fit with memoized
+    fitGaussian2RMat calls. Otherwise, the mean resolution profiles of all
+    forests are fit together with fitResolutionProfiles.
+
+    Args:
+        wave (ndarray): Shared wavelength grid.
+        reso (ndarray): (nspec, ndiags, nwave) resolution matrices.
+        rows (ndarray): Rows of reso.
+        i1, i2 (ndarray): Forest bounds for rows.
+        thids (ndarray): TARGETIDs for rows. Needed with fit_cache.
+        fit_cache (ResolutionFitCache): Memo of fitGaussian2RMat.
+    """
+    if rows.size == 0:
+        return np.empty(0)
+
+    if fit_cache is not None:
+        return np.array([
+            fit_cache(thids[n], wave[i1[n]:i2[n]], reso[i][:, i1[n]:i2[n]])
+            for n, i in enumerate(rows)])
+
+    loglam = np.log(wave)
+    dv = fid.LIGHT_SPEED * (loglam[i2 - 1] - loglam[i1]) / (i2 - 1 - i1)
+    return fitResolutionProfiles(
+        getMeanResolutionProfiles(reso, rows, i1, i2), dv)
+
+
+def _makeDeltaHDU(
+        thid, wave, delta, ivar, cont, meanf, z_qso, ra, dec, rmat,
+        dtype='f8', R_kms=None
+):
+    # dtype sets all columns but LAMBDA, which stays f8.
     ndiags = rmat.shape[0]
+    if ndiags > 1:
+        reso_dtype = ('RESOMAT', dtype, ndiags)
+    else:
+        reso_dtype = ('RESOMAT', dtype)
 
-    data = np.zeros(
-        wave.size, dtype=[('LAMBDA', 'f8'), ('DELTA', 'f8'), ('IVAR', 'f8'),
-                          ('CONT', 'f8'), ('MEANF', 'f8'),
-                          ('RESOMAT', 'f8', ndiags)]
+    data = np.empty(
+        wave.size, dtype=[('LAMBDA', 'f8'), ('DELTA', dtype), ('IVAR', dtype),
+                          ('CONT', dtype), ('MEANF', dtype), reso_dtype]
     )
 
     data['LAMBDA'] = wave
@@ -63,130 +343,586 @@ def saveDelta(
     data['MEANF'] = meanf
     if ndiags > 1:
         data['RESOMAT'] = rmat.T
-        R_kms = fitGaussian2RMat(thid, wave, rmat)
+        if R_kms is None:
+            R_kms = fitGaussian2RMat(thid, wave, rmat)
     else:
         data['RESOMAT'] = rmat[0]
         R_kms = 0.1
 
-    hdr_dict = {
+    hdr = fitsio.FITSHDR({
         'TARGETID': thid, 'RA': np.radians(ra), 'DEC': np.radians(dec),
         'Z': float(z_qso), 'MEANZ': np.mean(wave) / fid.LYA_WAVELENGTH - 1,
-        'MEANRESO': R_kms, 'MEANSNR': np.mean((1 + delta) * np.sqrt(ivar)),
+        'MEANRESO': R_kms,
+        'MEANSNR': np.mean((1 + delta) * np.sqrt(ivar), dtype=np.float64),
         'LIN_BIN': True, 'DLAMBDA': np.median(np.diff(wave))
-    }
+    })
 
-    fdelta.write(data, header=hdr_dict)
+    return data, hdr
 
 
-def read_coadd_into_dict(cfile):
-    coadd_hdu = fitsio.FITS(cfile)
+def saveDelta(
+        thid, wave, delta, ivar, cont, meanf, z_qso, ra, dec, rmat, fdelta,
+        dtype='f8'
+):
+    data, hdr = _makeDeltaHDU(
+        thid, wave, delta, ivar, cont, meanf, z_qso, ra, dec, rmat, dtype)
+    fdelta.write(data, header=hdr)
+
+
+class DeltaWriter():
+    """Writer of delta files with one HDU per forest.
+
+    Tables and prebuilt headers from ``_makeDeltaHDU`` are written in
+    ``add``. ``close`` logs the write throughput. Writes go to
+    ``fname.tmp``, which is renamed to ``fname`` on ``close``, so an
+    interrupted run never leaves a truncated file under the final name.
+    Exiting the context with an exception removes the temporary file
+    instead.
+    """
+
+    def __init__(self, fname, dtype='f8'):
+        self.fname = fname
+        self.tmp_fname = f"{fname}.tmp"
+        self.dtype = dtype
+        self.fts = fitsio.FITS(self.tmp_fname, "rw", clobber=True)
+        self.nwritten = 0
+        self.write_time = 0
+        self.t0 = time.perf_counter()
+
+    def add(self, thid, wave, delta, ivar, cont, meanf, z_qso, ra, dec,
+            rmat, R_kms=None):
+        # R_kms is fit from rmat if not given
+        data, hdr = _makeDeltaHDU(
+            thid, wave, delta, ivar, cont, meanf, z_qso, ra, dec, rmat,
+            self.dtype, R_kms)
+        t0 = time.perf_counter()
+        self.fts.write(data, header=hdr)
+        self.write_time += time.perf_counter() - t0
+        self.nwritten += 1
+
+    def close(self):
+        t0 = time.perf_counter()
+        self.fts.close()
+        os.replace(self.tmp_fname, self.fname)
+        self.write_time += time.perf_counter() - t0
+
+        total_time = time.perf_counter() - self.t0
+        logging.info(
+            f"Wrote {self.nwritten} spectra to {self.fname}: "
+            f"{self.nwritten / max(self.write_time, 1e-12):.0f} spectra/s "
+            f"in FITS writes, {self.nwritten / max(total_time, 1e-12):.0f} "
+            "spectra/s overall.")
+
+    def __enter__(self):
+        return self
+
+    def abort(self):
+        self.fts.close()
+        os.remove(self.tmp_fname)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def _getShardFname(fname, ishard, nshards):
+    return f"{fname}.shard-{ishard:04d}-of-{nshards:04d}"
+
+
+def mergeDeltaShards(fname, shard_fnames, remove=True):
+    """Concatenates shard delta files into a single delta file.
+
+    FITS extensions are self-contained blocks, so HDUs are copied as raw
+    bytes after the primary HDU of each shard without decoding tables.
+    Shards must have at least one forest, except when there is only one
+    shard, which is then renamed. The merged file is written to a temporary
+    name and renamed when complete.
+
+    Args:
+        fname (str): Output delta file.
+        shard_fnames (list(str)): Shard files in output order.
+        remove (bool): Remove shard files after merging.
+    """
+    t0 = time.perf_counter()
+    if len(shard_fnames) == 1:
+        if remove:
+            os.replace(shard_fnames[0], fname)
+        else:
+            shutil.copyfile(shard_fnames[0], f"{fname}.tmp")
+            os.replace(f"{fname}.tmp", fname)
+        return
+
+    tmp_fname = f"{fname}.tmp"
+    with open(tmp_fname, 'wb') as fout:
+        for j, fshard in enumerate(shard_fnames):
+            with fitsio.FITS(fshard) as fts:
+                first_ext = fts[0].get_offsets()['data_end']
+
+            with open(fshard, 'rb') as fin:
+                # keep the primary HDU of the first shard only
+                if j > 0:
+                    fin.seek(first_ext)
+                shutil.copyfileobj(fin, fout, 16 * 1024 * 1024)
+    os.replace(tmp_fname, fname)
+
+    if remove:
+        for fshard in shard_fnames:
+            os.remove(fshard)
+
+    logging.info(
+        f"Merged {len(shard_fnames)} shards into {fname} in "
+        f"{time.perf_counter() - t0:.2f} s.")
+
+
+def _getContiguousRuns(idx):
+    # Splits sorted indices into (start, stop) runs of consecutive values.
+    if idx.size == 0:
+        return []
+    breaks = np.nonzero(np.diff(idx) != 1)[0] + 1
+    starts = idx[np.r_[0, breaks]]
+    stops = idx[np.r_[breaks - 1, idx.size - 1]] + 1
+    return list(zip(starts, stops))
+
+
+def _readImageRows(hdu, runs, i1, i2):
+    # Reads rows in runs and columns i1:i2 of the last axis of an image
+    # with contiguous slices, so other fibers are never read.
+    ndim = len(hdu.get_dims())
+    mid = (slice(None),) * (ndim - 2)
+    if not runs:
+        # empty shard, keep the shape of other dimensions
+        return hdu[(slice(0, 1),) + mid + (slice(i1, i2),)][:0]
+    parts = [hdu[(slice(r1, r2),) + mid + (slice(i1, i2),)]
+             for r1, r2 in runs]
+    if len(parts) == 1:
+        return parts[0]
+    return np.concatenate(parts)
+
+
+def _coaddArms(arms_data):
+    # Inverse-variance weighted coadd of arms on the union wavelength
+    # grid. Arm grids must have the same pixel size and be aligned.
+    # Masked pixels are left out of the weights. Pixels masked in every arm
+    # are coadded without the mask, so that where a single arm covers the
+    # grid, the result is the same as reading that arm alone.
+    dw = np.median(np.diff(arms_data[0]['wave']))
+    wmin = min(d['wave'][0] for d in arms_data)
+    wmax = max(d['wave'][-1] for d in arms_data)
+    wave = wmin + dw * np.arange(int(round((wmax - wmin) / dw)) + 1)
+
+    nspec = arms_data[0]['flux'].shape[0]
+    ndiags = max(d['reso'].shape[1] for d in arms_data)
+    wsum = np.zeros((nspec, wave.size))
+    wflux = np.zeros((nspec, wave.size))
+    isum = np.zeros((nspec, wave.size))
+    iflux = np.zeros((nspec, wave.size))
+    # Uncovered pixels keep all bits set and are masked
+    mask = np.full((nspec, wave.size), -1, dtype=np.int32)
+    rsum = np.zeros((nspec, ndiags, wave.size))
+    rnorm = np.zeros((nspec, 1, wave.size))
+
+    for d in arms_data:
+        k1 = int(round((d['wave'][0] - wmin) / dw))
+        k2 = k1 + d['wave'].size
+        if not np.allclose(wave[k1:k2], d['wave'], rtol=0, atol=dw / 100):
+            raise ValueError("Wavelength grids of arms are not aligned.")
+
+        w = d['ivar'] * (d['mask'] == 0)
+        wsum[:, k1:k2] += w
+        wflux[:, k1:k2] += w * d['flux']
+        isum[:, k1:k2] += d['ivar']
+        iflux[:, k1:k2] += d['ivar'] * d['flux']
+        mask[:, k1:k2] &= d['mask']
+
+        # Resolution is weighted by ivar, or equally where all arms are
+        # masked. Narrower matrices are padded at both ends.
+        rw = np.where(w > 0, w, 1e-8)[:, None, :]
+        pad = (ndiags - d['reso'].shape[1]) // 2
+        rsum[:, pad:ndiags - pad, k1:k2] += rw * d['reso']
+        rnorm[:, :, k1:k2] += rw
 
     data = {}
-    data['fibermap'] = coadd_hdu['FIBERMAP'].read()
-    data['qso_idx'] = np.where(data['fibermap']['OBJTYPE'] == 'QSO')[0]
-
-    logging.info("Using only blue (B) arm.")
-    data['wave'] = coadd_hdu['B_WAVELENGTH'].read()
-    data['flux'] = coadd_hdu['B_FLUX'].read()
-    data['ivar'] = coadd_hdu['B_IVAR'].read()
-    data['mask'] = coadd_hdu['B_MASK'].read()
-    data['reso'] = coadd_hdu['B_RESOLUTION'].read()
-    coadd_hdu.close()
-
-    nuniq = np.unique(data['fibermap'][data['qso_idx']]['TARGETID']).size
-    logging.info(f"Number of QSO in simulated coadd {data['qso_idx'].size}")
-    logging.info(f"Unique targetid in simulated coadd {nuniq}")
+    data['wave'] = wave
+    good = wsum > 0
+    wsum = np.where(good, wsum, isum)
+    wflux = np.where(good, wflux, iflux)
+    data['flux'] = np.divide(
+        wflux, wsum, out=np.zeros_like(wflux), where=wsum > 0)
+    data['ivar'] = wsum
+    data['mask'] = mask
+    data['reso'] = rsum / np.where(rnorm > 0, rnorm, 1)
 
     return data
 
 
-class Reducer():
-    def __init__(self, args):
-        self.args = args
-        simspec_hdu = fitsio.FITS(args.simspec_file)
-        self.truth_fibermap = simspec_hdu['FIBERMAP'].read()
-        self.truth_qso_idx = np.where(
-            self.truth_fibermap['OBJTYPE'] == 'QSO')[0]
+def read_coadd_into_dict(
+        cfile, wave_range=None, arms=("B", "R", "Z"), shard=None
+):
+    """Reads quasar spectra of a coadd file.
+
+    Only QSO rows are read, with one contiguous slice per run of QSO
+    fibers. Only the arms in ``arms`` that exist in the file and overlap
+    ``wave_range`` are read, cut to that range, and they are coadded by
+    inverse variance when more than one is needed. Rows of the returned arrays are the QSO rows of
+    the fibermap, so qso_idx is a plain arange. If ``shard`` is given,
+    QSO rows are split into contiguous blocks of equal size and only the
+    requested block is read.
+
+    Args:
+        cfile (str): Coadd file.
+        wave_range (tuple(float, float)): Observed wavelength range. All
+            pixels if None.
+        arms (tuple(str)): Arms to consider.
+        shard (tuple(int, int)): Shard index and number of shards. All QSO
+            rows if None.
+
+    Returns:
+        data (dict): fibermap, qso_idx, wave, flux, ivar, mask and reso.
+    """
+    coadd_hdu = fitsio.FITS(cfile)
+
+    fibermap = coadd_hdu['FIBERMAP'].read()
+    qso_idx = np.where(fibermap['OBJTYPE'] == 'QSO')[0]
+    nuniq = np.unique(fibermap['TARGETID'][qso_idx]).size
+    logging.info(f"Number of QSO in simulated coadd {qso_idx.size}")
+    logging.info(f"Unique targetid in simulated coadd {nuniq}")
 
-        targetids = self.truth_fibermap[self.truth_qso_idx]['TARGETID']
-        logging.info(f"Number of QSO in truth {self.truth_qso_idx.size}")
+    if shard is not None:
+        ishard, nshards = shard
+        qso_idx = np.array_split(qso_idx, nshards)[ishard]
         logging.info(
-            f"Unique targetid in truth {np.unique(targetids).size}")
+            f"Reading shard {ishard + 1}/{nshards} with {qso_idx.size} QSO.")
+
+    runs = _getContiguousRuns(qso_idx)
+
+    arms_data = []
+    for arm in arms:
+        if f'{arm}_WAVELENGTH' not in coadd_hdu:
+            logging.debug(f"{cfile} has no {arm} arm.")
+            continue
+
+        wave = coadd_hdu[f'{arm}_WAVELENGTH'].read()
+        i1, i2 = 0, wave.size
+        if wave_range is not None:
+            i1, i2 = np.searchsorted(wave, wave_range)
+        if i2 - i1 < 2:
+            continue
+
+        d = {'wave': wave[i1:i2]}
+        for key, ext in [('flux', 'FLUX'), ('ivar', 'IVAR'), ('mask', 'MASK'),
+                         ('reso', 'RESOLUTION')]:
+            d[key] = _readImageRows(coadd_hdu[f'{arm}_{ext}'], runs, i1, i2)
+        d['arm'] = arm
+        arms_data.append(d)
+    coadd_hdu.close()
 
-        self.truth_wave = simspec_hdu['WAVE'].read()
-        self.truth_flux = simspec_hdu['FLUX_TRUE'].read()
-        self.truth_zqso = simspec_hdu['TRUTH']['REDSHIFT'].read()
-        simspec_hdu.close()
+    if not arms_data:
+        raise ValueError(f"No arm of {cfile} overlaps {wave_range}.")
 
-    def _isShort(self, z_qso, dlambda, remaining_pixels):
-        MAX_NO_PIXELS = int(
-            (fid.LYA_LAST_WVL - fid.LYA_FIRST_WVL) * (1 + z_qso) / dlambda)
-        return (np.sum(remaining_pixels) < MAX_NO_PIXELS * self.args.skip)
+    used_arms = "".join(d['arm'] for d in arms_data)
+    logging.info(f"Using {used_arms} arm(s) of {cfile}.")
+    if len(arms_data) == 1:
+        data = arms_data[0]
+        del data['arm']
+    else:
+        data = _coaddArms(arms_data)
 
-    def __call__(self, cfile):
-        print(f"Reading {cfile}")
-        coadd_data = read_coadd_into_dict(cfile)
-        suffix = cfile.split("/")[-1]
-        output_delta_fname = f"{self.args.outputdir}/delta-{suffix[6:]}"
+    data['fibermap'] = fibermap[qso_idx]
+    data['qso_idx'] = np.arange(qso_idx.size)
 
-        delta_hdu = fitsio.FITS(output_delta_fname, "rw", clobber=True)
-        logging.info("Spectra are read.")
-        logging.info(f"There are {coadd_data['qso_idx'].size} quasars.")
+    return data
 
-        for i in coadd_data['qso_idx']:
-            thid = coadd_data['fibermap']['TARGETID'][i]
-            ra = coadd_data['fibermap']['TARGET_RA'][i]
-            dec = coadd_data['fibermap']['TARGET_DEC'][i]
-            jj = np.nonzero(self.truth_fibermap['TARGETID'] == thid)[0][0]
-            z_qso = self.truth_zqso[jj]
-            assert (z_qso > 2)
-
-            # cut out forest, but do not remove masked pixels individually
-            # resolution matrix assumes all pixels to be present
-            forest_pixels = getForestAnalysisRegion(
-                coadd_data['wave'], z_qso, self.args)
-            remaining_pixels = forest_pixels & ~coadd_data['mask'][i]
-
-            if np.sum(remaining_pixels) < 15:
-                # Empty spectrum
-                continue
 
-            wave = coadd_data['wave'][forest_pixels]
-            # Skip short chunks
-            isshort = self._isShort(z_qso, wave[1] - wave[0], remaining_pixels)
-            if self.args.skip and isshort:
-                # Short chunk
-                continue
+TRUTH_ARRAYS = ("wave", "flux", "zqso", "order", "sorted_targetids")
+
+
+def cacheTruthArrays(simspec_file, cache_dir, float32=False):
+    """Saves simspec truth arrays as .npy files for memory mapping.
+
+    The cache is keyed by the path, size and modification time of the
+    simspec file, so it is only written once per input.
+
+    Returns:
+        truth_dir (str): Directory with one .npy file per TRUTH_ARRAYS.
+    """
+    simspec_file = os.path.abspath(simspec_file)
+    st = os.stat(simspec_file)
+    key = hashlib.sha1(repr(
+        (simspec_file, st.st_size, st.st_mtime_ns, float32)).encode()
+    ).hexdigest()[:16]
+    truth_dir = f"{cache_dir}/truth-{key}"
+    if os.path.isdir(truth_dir):
+        logging.info(f"Using cached truth arrays in {truth_dir}.")
+        return truth_dir
+
+    simspec_hdu = fitsio.FITS(simspec_file)
+    truth_fibermap = simspec_hdu['FIBERMAP'].read()
+    truth_qso_idx = np.where(truth_fibermap['OBJTYPE'] == 'QSO')[0]
+
+    targetids = truth_fibermap[truth_qso_idx]['TARGETID']
+    logging.info(f"Number of QSO in truth {truth_qso_idx.size}")
+    logging.info(f"Unique targetid in truth {np.unique(targetids).size}")
+
+    truth = {}
+    truth['wave'] = simspec_hdu['WAVE'].read()
+    truth['flux'] = simspec_hdu['FLUX_TRUE'].read()
+    if float32:
+        truth['flux'] = truth['flux'].astype(np.float32, copy=False)
+    truth['zqso'] = simspec_hdu['TRUTH']['REDSHIFT'].read()
+    simspec_hdu.close()
+
+    # Sorted TARGETID index of truth rows. Stable sort keeps the first
+    # occurrence of a duplicate TARGETID first, which is the one used.
+    truth_targetids = truth_fibermap['TARGETID']
+    truth['order'] = np.argsort(truth_targetids, kind='stable')
+    truth['sorted_targetids'] = truth_targetids[truth['order']]
+    ndups = np.count_nonzero(np.diff(truth['sorted_targetids']) == 0)
+    if ndups > 0:
+        logging.warning(
+            f"{ndups} duplicate TARGETID rows in truth. Using the first.")
+
+    # Write everything under a temporary name, so an interrupted run
+    # never leaves a partial cache behind.
+    tmp_dir = f"{truth_dir}.{os.getpid()}.tmp"
+    os_makedirs(tmp_dir, exist_ok=True)
+    for name, arr in truth.items():
+        np.save(f"{tmp_dir}/{name}.npy", np.ascontiguousarray(arr))
+    try:
+        os.rename(tmp_dir, truth_dir)
+    except OSError:
+        # Another run cached the same file meanwhile
+        shutil.rmtree(tmp_dir)
+    logging.info(f"Cached truth arrays in {truth_dir}.")
+
+    return truth_dir
+
+
+_TRUTH_INTERP = None
+
+
+def _getTruthInterp(wave, truth_wave, truth_dir):
+    # A Reducer is pickled for every task, so the weights are kept per
+    # process instead. Coadds of a run share the wavelength grid, so they
+    # are usually computed once per worker.
+    global _TRUTH_INTERP
+    if (_TRUTH_INTERP is None or _TRUTH_INTERP[0] != truth_dir
+            or not np.array_equal(_TRUTH_INTERP[1], wave)):
+        _TRUTH_INTERP = (
+            truth_dir, wave, InterpWeights(wave, truth_wave))
+    return _TRUTH_INTERP[2]
 
-            # cont_interp = interp1d(self.truth_wave, self.truth_flux[jj])
-            # cont = cont_interp(wave)
 
-            z = wave / fid.LYA_WAVELENGTH - 1
-            cont = np.interp(wave, self.truth_wave, self.truth_flux[jj])
-            w = cont <= 0
+class Reducer():
+    # Truth arrays are read-only memory maps of the cache in
+    # cacheTruthArrays. Pickling a Reducer sends only the cache path, and
+    # every worker attaches the same pages instead of holding a copy.
+    def __init__(self, args, truth_dir):
+        self.args = args
+        self.truth_dir = truth_dir
+        self.dtype = np.float32 if args.float32 else np.float64
+        self.truth_interp = None
+        self._attachTruth()
+
+    def _attachTruth(self):
+        for name in TRUTH_ARRAYS:
+            setattr(self, f"truth_{name}", np.load(
+                f"{self.truth_dir}/{name}.npy", mmap_mode='r'))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in TRUTH_ARRAYS:
+            del state[f"truth_{name}"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._attachTruth()
+
+    def findTruthRows(self, targetids):
+        """Returns truth row indices for targetids, -1 where missing."""
+        idx = np.searchsorted(self.truth_sorted_targetids, targetids)
+        idx = np.minimum(idx, self.truth_sorted_targetids.size - 1)
+        found = self.truth_sorted_targetids[idx] == targetids
+        return np.where(found, self.truth_order[idx], -1)
+
+    def _iterDeltas(self, coadd_data, rows, truth_rows, i1, i2, dtype):
+        return iterForestDeltas(
+            coadd_data['wave'], coadd_data['flux'], coadd_data['ivar'], rows,
+            self.truth_interp, self.truth_flux, truth_rows, i1, i2, dtype)
+
+    def _validateFloat32(self, coadd_data, rows, truth_rows, i1, i2):
+        # Compares the first forest against double precision
+        thid = coadd_data['fibermap']['TARGETID'][rows[0]]
+        ref, test = [
+            next(self._iterDeltas(
+                coadd_data, rows[:1], truth_rows[:1], i1[:1], i2[:1], dtype))
+            for dtype in (np.float64, np.float32)]
+        for label, x64, x32 in zip(["delta", "ivar"], ref[:2], test[:2]):
+            logging.info(utils.float32_difference_report(
+                f"{label} of TARGETID {thid}", x64, x32))
+
+    def __call__(self, task):
+        # task is (cfile, ishard, nshards). Shards of a file are written to
+        # separate files that main merges once all of them are done.
+        cfile, ishard, nshards = task
+        # The first shard records the coadd for the completion marker
+        inputs = None
+        if ishard == 0:
+            inputs = utils.describe_input_files(
+                [cfile], checksum=self.args.skip_existing)
 
-            flux = coadd_data['flux'][i][forest_pixels] / cont
-            ivar = coadd_data['ivar'][i][forest_pixels] * cont**2
-            # mask = coadd_mask[i][forest_pixels] - buggy
-            # Cut rmat forest region, but keep individual bad pixel values in
-            rmat = np.delete(coadd_data['reso'][i], ~forest_pixels, axis=1)
+        print(f"Reading {cfile}")
+        shard = (ishard, nshards) if nshards > 1 else None
+        coadd_data = read_coadd_into_dict(
+            cfile, getForestWindow(self.args), self.args.arms, shard)
+        output_delta_fname = getDeltaFname(cfile, self.args.outputdir)
+        if shard is not None:
+            output_delta_fname = _getShardFname(
+                output_delta_fname, ishard, nshards)
 
-            # Make it delta
-            tr_mf = TRUE_MEAN_FLUX(z)
-            delta = flux / tr_mf - 1
-            ivar = ivar * tr_mf**2
-            delta[w] = 0
-            ivar[w] = 0
+        logging.info("Spectra are read.")
+        logging.info(f"There are {coadd_data['qso_idx'].size} quasars.")
 
-            # Mask by setting things to 0
-            # delta[mask] = 0
-            # ivar[mask]  = 0
+        qso_idx = coadd_data['qso_idx']
+        fibermap = coadd_data['fibermap']
+        qso_targetids = fibermap['TARGETID'][qso_idx]
+        truth_rows = self.findTruthRows(qso_targetids)
+        missing = truth_rows < 0
+        if missing.any():
+            logging.warning(
+                f"{missing.sum()} quasars in {cfile} are not in truth and "
+                f"skipped. TARGETIDs: {qso_targetids[missing]}")
+        uniq, counts = np.unique(qso_targetids, return_counts=True)
+        if uniq.size < qso_targetids.size:
+            logging.warning(
+                f"Duplicate quasar TARGETIDs in {cfile}: {uniq[counts > 1]}")
+
+        rows, truth_rows = qso_idx[~missing], truth_rows[~missing]
+        z_qso = self.truth_zqso[truth_rows]
+        assert np.all(z_qso > 2)
+
+        # cut out forest, but do not remove masked pixels individually
+        # resolution matrix assumes all pixels to be present
+        wave = coadd_data['wave']
+        i1, i2 = getForestBounds(wave, z_qso, self.args)
+        ngood = np.zeros((rows.size, wave.size + 1), dtype=int)
+        np.cumsum(coadd_data['mask'][rows] == 0, axis=1, out=ngood[:, 1:])
+        remaining = np.take_along_axis(ngood, i2[:, None], 1)[:, 0]
+        remaining -= np.take_along_axis(ngood, i1[:, None], 1)[:, 0]
+
+        # Empty spectra
+        keep = remaining >= 15
+        if self.args.skip:
+            # Short chunks
+            dlambda = wave[np.minimum(i1 + 1, wave.size - 1)] - wave[i1]
+            keep &= ~getShortForests(
+                z_qso, dlambda, remaining, self.args.skip)
+
+        rows, truth_rows, z_qso = rows[keep], truth_rows[keep], z_qso[keep]
+        i1, i2 = i1[keep], i2[keep]
+
+        self.truth_interp = _getTruthInterp(
+            wave, self.truth_wave, self.truth_dir)
+
+        if self.args.float32 and rows.size > 0:
+            self._validateFloat32(coadd_data, rows, truth_rows, i1, i2)
+
+        reso_cache = None
+        if not self.args.fast_reso:
+            reso_cache = _getResolutionFitCache(self.args.reso_cache_size)
+        R_kms = fitResolutionWidths(
+            wave, coadd_data['reso'], rows, i1, i2,
+            fibermap['TARGETID'][rows], reso_cache)
+        if reso_cache is not None:
+            logging.info(
+                f"Resolution fits in this process: {reso_cache.nhits} memo "
+                f"hits, {reso_cache.nmisses} fits.")
+
+        forests = self._iterDeltas(
+            coadd_data, rows, truth_rows, i1, i2, self.dtype)
+        with DeltaWriter(output_delta_fname, dtype=self.dtype) as delta_writer:
+            for n, (delta, ivar, cont, tr_mf) in enumerate(forests):
+                i = rows[n]
+                # Cut rmat forest region, but keep individual bad pixel
+                # values in
+                rmat = coadd_data['reso'][i][:, i1[n]:i2[n]]
+                delta_writer.add(
+                    fibermap['TARGETID'][i], wave[i1[n]:i2[n]], delta, ivar,
+                    cont, tr_mf, z_qso[n], fibermap['TARGET_RA'][i],
+                    fibermap['TARGET_DEC'][i], rmat, R_kms[n])
+
+        return task, delta_writer.nwritten, inputs
+
+
+def getDeltaFname(cfile, outputdir):
+    suffix = cfile.split("/")[-1]
+    return f"{outputdir}/delta-{suffix[6:]}"
+
+
+def getOutputOptions(args):
+    # Options that change delta files. Completion markers record them, so
+    # --skip-existing redoes outputs of different settings.
+    return {key: getattr(args, key) for key in [
+        "desi_w1", "desi_w2", "z_forest_min", "z_forest_max", "skip",
+        "float32", "fast_reso", "arms"]}
+
+
+def getNumberOfShards(ncoadds, nproc, shards_per_file=None):
+    """Number of shards per coadd file so that all processes have work.
+
+    Args:
+        ncoadds (int): Number of coadd files.
+        nproc (int): Number of processes.
+        shards_per_file (int): Fixed number of shards. Automatic if None
+            or 0.
+
+    Returns:
+        nshards (int)
+    """
+    if shards_per_file:
+        return shards_per_file
+    return max(1, -(-nproc // ncoadds))
+
+
+def processCoadds(args, coadd_files, truth_dir, options):
+    """Writes delta files of coadd_files and their completion markers."""
+    nshards = getNumberOfShards(
+        len(coadd_files), args.nproc, args.shards_per_file)
+    tasks = [(cfile, ishard, nshards) for cfile in coadd_files
+             for ishard in range(nshards)]
+    logging.info(
+        f"Processing {len(coadd_files)} coadds in {nshards} shard(s) each.")
+
+    # Merge shards of a file as soon as its last shard is done. Shards
+    # without forests have no valid FITS HDU and are only removed. The
+    # completion marker is written once the delta file is in place.
+    simspec_inputs = utils.describe_input_files(
+        [args.simspec_file], checksum=args.skip_existing)
+    nforests, coadd_inputs = {}, {}
+    nproc = min(len(tasks), args.nproc)
+    with Pool(processes=nproc) as pool:
+        for (cfile, ishard, _), nwritten, inputs in pool.imap_unordered(
+                Reducer(args, truth_dir), tasks):
+            nforests.setdefault(cfile, {})[ishard] = nwritten
+            if inputs is not None:
+                coadd_inputs[cfile] = inputs
+            if len(nforests[cfile]) < nshards:
+                continue
 
-            # Save it
-            saveDelta(thid, wave, delta, ivar, cont, tr_mf,
-                      z_qso, ra, dec, rmat, delta_hdu)
+            fname = getDeltaFname(cfile, args.outputdir)
+            if nshards > 1:
+                shard_fnames = [_getShardFname(fname, j, nshards)
+                                for j in range(nshards)]
+                nonempty = [f for j, f in enumerate(shard_fnames)
+                            if nforests[cfile][j] > 0] or shard_fnames[:1]
+                mergeDeltaShards(fname, nonempty)
+                for f in set(shard_fnames) - set(nonempty):
+                    os.remove(f)
 
-        delta_hdu.close()
+            utils.write_completion_marker(
+                fname, {**coadd_inputs.pop(cfile), **simspec_inputs}, options)
 
 
 def main():
@@ -216,14 +952,69 @@ def main():
         "--nproc", help="number of cores available", default=32, type=int)
     parser.add_argument(
         "--skip", help="Skip short chunks lower than given ratio", type=float)
+    parser.add_argument(
+        "--float32", action="store_true",
+        help="Compute and save deltas in single precision.")
+    parser.add_argument(
+        "--fast-reso", action="store_true",
+        help="Fit MEANRESO to the mean resolution profiles of all forests "
+             "of a file at once instead of memoized fitGaussian2RMat calls.")
+    parser.add_argument(
+        "--reso-cache-size", type=int, default=4096,
+        help="Maximum number of memoized resolution fits per process.")
+    parser.add_argument(
+        "--arms", nargs='+', choices=["B", "R", "Z"], default=["B", "R", "Z"],
+        help="Arms to read. Only the ones overlapping the forest window are "
+             "used, and are coadded if there are more than one.")
+    parser.add_argument(
+        "--shards-per-file", type=int, default=0,
+        help="Split quasars of each coadd into this many shards that are "
+             "processed in parallel and merged. Default: enough shards to "
+             "use all processes.")
+    parser.add_argument(
+        "--skip-existing", action="store_true",
+        help="Skip coadds whose delta file is complete, i.e. has a "
+             "completion marker matching the inputs and options.")
+    parser.add_argument(
+        "--truth-cache-dir",
+        help="Directory to keep memory-mapped truth arrays shared by "
+             "workers for later runs. Default: a temporary directory that "
+             "is removed at the end.")
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.DEBUG)
 
     os_makedirs(args.outputdir, exist_ok=True)
-
-    nproc = min(len(args.coadd_file), args.nproc)
-    with Pool(processes=nproc) as pool:
-        pool.map(Reducer(args), args.coadd_file)
+    options = getOutputOptions(args)
+    coadd_files = args.coadd_file
+    if args.skip_existing:
+        coadd_files = [
+            cfile for cfile in coadd_files
+            if not utils.is_output_complete(
+                getDeltaFname(cfile, args.outputdir),
+                [cfile, args.simspec_file], options)]
+        logging.info(
+            f"Skipping {len(args.coadd_file) - len(coadd_files)} coadds with "
+            "complete delta files.")
+        if not coadd_files:
+            logging.info("Done")
+            return
+
+    for cfile in coadd_files:
+        utils.remove_completion_marker(getDeltaFname(cfile, args.outputdir))
+
+    # Truth arrays are uncompressed copies of the simspec file, so they are
+    # only kept if asked for.
+    truth_cache_dir = args.truth_cache_dir
+    if truth_cache_dir is None:
+        truth_cache_dir = tempfile.mkdtemp(prefix="truth-cache-")
+    os_makedirs(truth_cache_dir, exist_ok=True)
+    try:
+        truth_dir = cacheTruthArrays(
+            args.simspec_file, truth_cache_dir, args.float32)
+        processCoadds(args, coadd_files, truth_dir, options)
+    finally:
+        if args.truth_cache_dir is None:
+            shutil.rmtree(truth_cache_dir, ignore_errors=True)
 
     logging.info("Done")
@@ -6,11 +6,23 @@ import fitsio
 import numpy as np
 # from scipy.interpolate import interp1d
 
-import qsotools.fiducial as fid
-from qsotools.mocklib import lognMeanFluxGH as TRUE_MEAN_FLUX
-
+from desi_y1_p1d import utils
 from desi_y1_p1d.get_deltas_from_pixsim_coadd import (
-    getForestAnalysisRegion, saveDelta)
+    getForestBounds, getShortForests, InterpWeights, iterForestDeltas,
+    DeltaWriter)
+
+
+def getDeltaFname(simspec_file, outputdir):
+    suffix = simspec_file.split("/")[-1]
+    _len = len("simspec-")
+    return f"{outputdir}/delta-{suffix[_len:]}"
+
+
+def getOutputOptions(args):
+    # Options that change the delta file, recorded in completion markers
+    return {key: getattr(args, key) for key in [
+        "desi_w1", "desi_w2", "z_forest_min", "z_forest_max", "skip",
+        "float32"]}
 
 
 class Reducer():
@@ -32,71 +44,70 @@ class Reducer():
         self.truth_zqso = simspec_hdu['TRUTH']['REDSHIFT'].read()
         simspec_hdu.close()
 
-        suffix = args.simspec_file.split("/")[-1]
-        _len = len("simspec-")
-        self.odelta_fname = f"{self.args.outputdir}/delta-{suffix[_len:]}"
+        self.dtype = np.float64
+        if args.float32:
+            self.dtype = np.float32
+            self.influx = self.influx.astype(np.float32, copy=False)
+            self.truth_flux = self.truth_flux.astype(np.float32, copy=False)
+
+        self.odelta_fname = getDeltaFname(args.simspec_file, args.outputdir)
+
+    def _iterDeltas(self, rows, i1, i2, dtype):
+        # Input flux is on the truth grid, so interpolation is an identity
+        # and rows are the same in both.
+        # ivar = coadd_data['ivar'][i][forest_pixels] * cont**2
+        # mask = coadd_mask[i][forest_pixels] - buggy
+        return iterForestDeltas(
+            self.truth_wave, self.influx, 1e4, rows, self.truth_interp,
+            self.truth_flux, rows, i1, i2, dtype, mask_bad_cont=False)
+
+    def _validateFloat32(self, rows, i1, i2):
+        # Compares the first forest against double precision
+        thid = self.truth_fibermap['TARGETID'][rows[0]]
+        ref, test = [
+            next(self._iterDeltas(rows[:1], i1[:1], i2[:1], dtype))
+            for dtype in (np.float64, np.float32)]
+        for label, x64, x32 in zip(["delta", "ivar"], ref[:2], test[:2]):
+            logging.info(utils.float32_difference_report(
+                f"{label} of TARGETID {thid}", x64, x32))
 
     def __call__(self):
-        delta_hdu = fitsio.FITS(self.odelta_fname, "rw", clobber=True)
-
-        for i in self.truth_qso_idx:
-            thid = self.truth_fibermap['TARGETID'][i]
-            ra = self.truth_fibermap['TARGET_RA'][i]
-            dec = self.truth_fibermap['TARGET_DEC'][i]
-            jj = i
-            z_qso = self.truth_zqso[jj]
-            assert (z_qso > 2)
-
-            # cut out forest, but do not remove masked pixels individually
-            # resolution matrix assumes all pixels to be present
-            forest_pixels = getForestAnalysisRegion(
-                self.truth_wave, z_qso, self.args)
-            remaining_pixels = forest_pixels
-
-            if np.sum(remaining_pixels) < 15:
-                # Empty spectrum
-                continue
-
-            wave = self.truth_wave[forest_pixels]
-            dlambda = np.mean(np.diff(wave))
-
-            # Skip short chunks
-            MAX_NO_PIXELS = int(
-                (fid.LYA_LAST_WVL - fid.LYA_FIRST_WVL) * (1 + z_qso) / dlambda
-            )
-            if self.args.skip and (np.sum(remaining_pixels) < MAX_NO_PIXELS * self.args.skip):
-                # Short chunk
-                continue
-
-            # cont_interp = interp1d(self.truth_wave, self.truth_flux[jj])
-            # cont = cont_interp(wave)
-            cont = np.interp(wave, self.truth_wave, self.truth_flux[jj])
-            z = wave / fid.LYA_WAVELENGTH - 1
-
-            flux = self.influx[i][forest_pixels] / cont
-            # ivar = coadd_data['ivar'][i][forest_pixels] * cont**2
-            # rmat = coadd_data['reso'][i][:, forest_pixels]
-            # mask = coadd_mask[i][forest_pixels] - buggy
-            # Cut rmat forest region, but keep individual bad pixel values in
-            ivar = 1e4 * cont**2
-            rmat = np.ones((1, flux.size))
-            # np.delete(coadd_data['reso'][i], ~forest_pixels, axis=1)
-
-            # Make it delta
-            tr_mf = TRUE_MEAN_FLUX(z)
-            delta = flux / tr_mf - 1
-            ivar = ivar * tr_mf**2
-
-            # Mask by setting things to 0
-            # delta[mask] = 0
-            # ivar[mask]  = 0
-
-            # Save it
-            saveDelta(
-                thid, wave, delta, ivar, cont, tr_mf,
-                z_qso, ra, dec, rmat, delta_hdu)
-
-        delta_hdu.close()
+        rows = self.truth_qso_idx
+        z_qso = self.truth_zqso[rows]
+        assert np.all(z_qso > 2)
+
+        # cut out forest, but do not remove masked pixels individually
+        # resolution matrix assumes all pixels to be present
+        i1, i2 = getForestBounds(self.truth_wave, z_qso, self.args)
+        npixels = i2 - i1
+
+        # Empty spectra
+        keep = npixels >= 15
+        if self.args.skip:
+            # Short chunks. Mean pixel size from the forest end points.
+            dlambda = (
+                self.truth_wave[np.maximum(i2 - 1, i1)] - self.truth_wave[i1]
+            ) / np.maximum(npixels - 1, 1)
+            keep &= ~getShortForests(z_qso, dlambda, npixels, self.args.skip)
+
+        rows, z_qso, i1, i2 = rows[keep], z_qso[keep], i1[keep], i2[keep]
+        self.truth_interp = InterpWeights(self.truth_wave, self.truth_wave)
+        if self.args.float32 and rows.size > 0:
+            self._validateFloat32(rows, i1, i2)
+
+        forests = self._iterDeltas(rows, i1, i2, self.dtype)
+        with DeltaWriter(self.odelta_fname, dtype=self.dtype) as delta_writer:
+            for n, (delta, ivar, cont, tr_mf) in enumerate(forests):
+                i = rows[n]
+                rmat = np.ones((1, delta.size), dtype=self.dtype)
+                # np.delete(coadd_data['reso'][i], ~forest_pixels, axis=1)
+
+                # Save it
+                delta_writer.add(
+                    self.truth_fibermap['TARGETID'][i],
+                    self.truth_wave[i1[n]:i2[n]], delta, ivar, cont, tr_mf,
+                    z_qso[n], self.truth_fibermap['TARGET_RA'][i],
+                    self.truth_fibermap['TARGET_DEC'][i], rmat)
 
 
 def main():
@@ -118,11 +129,29 @@ def main():
         "--z-forest-max", help="Upper end of the forest. Default: %(default)s",
         type=float, default=3.5)
     parser.add_argument("--skip", help="Skip short chunks lower than given ratio", type=float)
+    parser.add_argument(
+        "--float32", action="store_true",
+        help="Compute and save deltas in single precision.")
+    parser.add_argument(
+        "--skip-existing", action="store_true",
+        help="Skip if the delta file is complete, i.e. has a completion "
+             "marker matching the simspec file and options.")
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.DEBUG)
 
     os_makedirs(args.outputdir, exist_ok=True)
+    odelta_fname = getDeltaFname(args.simspec_file, args.outputdir)
+    options = getOutputOptions(args)
+    if args.skip_existing and utils.is_output_complete(
+            odelta_fname, [args.simspec_file], options):
+        logging.info(f"{odelta_fname} is complete. Skipping.")
+        return
+
+    utils.remove_completion_marker(odelta_fname)
+    inputs = utils.describe_input_files(
+        [args.simspec_file], checksum=args.skip_existing)
     reducer = Reducer(args)
 
     reducer()
+    utils.write_completion_marker(odelta_fname, inputs, options)
@@ -1,12 +1,19 @@
 import argparse
+import functools
 from multiprocessing import Pool
+import os
 from os import makedirs
 
 import fitsio
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+import scipy.fft
 from tqdm import tqdm
 
+from desi_y1_p1d import utils
+
 
 def parse(options=None):
     parser = argparse.ArgumentParser(
@@ -19,12 +26,61 @@ def parse(options=None):
     parser.add_argument("--mdown", type=int, default=4, help="downsample")
     parser.add_argument("--save-images", action="store_true")
     parser.add_argument("--nproc", default=None, type=int)
+    parser.add_argument(
+        "--nthreads", default=1, type=int,
+        help="FFT threads per process. Total cores: nproc x nthreads.")
+    parser.add_argument(
+        "--float32", action="store_true",
+        help="Transform images in single precision. Powers are averaged "
+             "and saved in double precision.")
+    parser.add_argument(
+        "--resume", action="store_true",
+        help="Keep exposures in an existing preproc-zeros-powers.fits and "
+             "only process the ones missing from it.")
+    parser.add_argument(
+        "--flush-every", type=int, default=32,
+        help="Flush the output file after this many exposures.")
+    parser.add_argument(
+        "--no-plots", action="store_true",
+        help="Compute and save powers only. Plot them later with --render.")
+    parser.add_argument(
+        "--render", action="store_true",
+        help="Only render plots from preproc-zeros-powers.fits in outdir.")
+    parser.add_argument(
+        "--render-cams", nargs="+", help="Cameras to render, e.g. b1 r1.")
+    parser.add_argument(
+        "--render-nights", nargs=2, type=int,
+        help="First and last night to render.")
+    parser.add_argument(
+        "--means-only", action="store_true",
+        help="Render only per-camera mean powers.")
+    parser.add_argument(
+        "--clip-nsigma", type=float, default=3.,
+        help="Clipping threshold for the robust per-camera and per-night "
+             "stacks.")
+    parser.add_argument(
+        "--table-output", action="store_true",
+        help="Save powers as rows of a single binary table in "
+             "preproc-zeros-powers-table.fits instead of one HDU per "
+             "exposure. Applies to --resume and --render as well.")
     args = parser.parse_args(options)
 
     return args
 
 
-def getpower(im, n, mpad, mdown, da=0.6):
+def _getSlicePowers(half, n, nl, mdown, da, ny, workers):
+    # FFT all n-column slices of half in one batch along the rows.
+    nrows, ncols = half.shape
+    nslices = ncols // n
+    grid = half[:, :nslices * n].reshape(nrows, nslices, n)
+    d = scipy.fft.rfft(grid, n=nl, axis=0, workers=workers)[:-1]
+    d *= da
+    p = np.mean(d.real**2 + d.imag**2, axis=2, dtype=np.float64)
+    M = p.shape[0]
+    return p.reshape(M // mdown, mdown, nslices).mean(axis=1).T / (da * ny)
+
+
+def getpower(im, n, mpad, mdown, da=0.6, workers=1, dtype=np.float64):
     Nx, Ny = im.shape
     ny = Ny // 2
     nl = ny * mpad
@@ -32,21 +88,32 @@ def getpower(im, n, mpad, mdown, da=0.6):
     M = k.size
     k = k.reshape(M // mdown, mdown).mean(axis=-1)
 
-    kplist = [k]
-    for i in range(0, Nx, n):
-        grid = im[:ny, i:i + n]
-        d = np.fft.rfft(grid, axis=0, n=nl)[:-1] * da
-        kplist.append(
-            np.mean(np.abs(d)**2, axis=1).reshape(
-                M // mdown, mdown).mean(axis=-1) / (da * ny))
+    im = np.asarray(im, dtype=dtype)
+    # Column slices start every n pixels up to Nx. Full-width slices are
+    # batched, a narrower last slice is transformed on its own. Slices
+    # beyond Ny are empty and their power is NaN. Zero-width batches, e.g.
+    # no full slice if n > Ny, are dropped.
+    nslices = -(-Nx // n)
+    ncols = min(Ny, nslices * n)
+    nfull = ncols // n
+    slices = [(i1, i2) for i1, i2 in [(0, nfull * n), (nfull * n, ncols)]
+              if i2 > i1]
+
+    powers = []
+    for i1, i2 in slices:
+        w = min(n, i2 - i1)
+        top = _getSlicePowers(im[:ny, i1:i2], w, nl, mdown, da, ny, workers)
+        bot = _getSlicePowers(im[ny:, i1:i2], w, nl, mdown, da, ny, workers)
+        interleaved = np.empty((2 * top.shape[0], top.shape[1]))
+        interleaved[0::2] = top
+        interleaved[1::2] = bot
+        powers.append(interleaved)
 
-        grid = im[ny:, i:i + n]
-        d = np.fft.rfft(grid, axis=0, n=nl)[:-1] * da
-        kplist.append(
-            np.mean(np.abs(d)**2, axis=1).reshape(
-                M // mdown, mdown).mean(axis=-1) / (da * ny))
+    nempty = nslices - nfull - int(nfull * n < ncols)
+    if nempty > 0:
+        powers.append(np.full((2 * nempty, k.size), np.nan))
 
-    return kplist
+    return [k] + list(np.vstack(powers))
 
 
 def save_image(im, fname):
@@ -56,16 +123,35 @@ def save_image(im, fname):
     plt.close()
 
 
+_POWER_FIGURES = {}
+
+
+def _getPowerFigure(nrow, ncol):
+    # Figures are created once per layout and process, and drawn on the
+    # Agg canvas directly without pyplot state.
+    key = (nrow, ncol)
+    if key not in _POWER_FIGURES:
+        fig = Figure(figsize=(6 * ncol, 2.4 * nrow))
+        FigureCanvasAgg(fig)
+        axs = fig.subplots(
+            nrow, ncol, sharex='all', squeeze=False,
+            gridspec_kw={'hspace': 0, 'wspace': 0.1})
+        _POWER_FIGURES[key] = (fig, axs)
+
+    return _POWER_FIGURES[key]
+
+
 def save_power_image(kplist, n, title, fname):
     k = kplist[0]
     i1, i2 = np.searchsorted(k, [1e-1, 1.0])
     nrow = len(kplist) - 1
     ncol = 4
     nrow = nrow // ncol
-    fig, axs = plt.subplots(
-        nrow, ncol, figsize=(6 * ncol, 2.4 * nrow),
-        sharex='all', gridspec_kw={'hspace': 0, 'wspace': 0.1})
+    fig, axs = _getPowerFigure(nrow, ncol)
     fig.suptitle(title, fontsize=16)
+    for ax in axs.flat:
+        ax.cla()
+
     for i, p in enumerate(kplist[1:]):
         r = i // ncol
         c = i % ncol
@@ -90,66 +176,603 @@ def save_power_image(kplist, n, title, fname):
         ax.set_xlim(1e-1, 1)
     for ax in axs[:, 0]:
         ax.set_ylabel("P [A]", fontsize=14)
-    plt.savefig(fname, dpi=150, bbox_inches='tight')
-    plt.close()
+    fig.savefig(fname, dpi=150, bbox_inches='tight')
 
 
-def one_wrap(f, args):
+def _splitFname(f):
     fbase = f.split('/')[-1]
     if fbase.endswith(".fits"):
         ext = ".fits"
     elif fbase.endswith(".fits.gz"):
         ext = ".fits.gz"
     else:
+        return None, None, None
+    cam, expid = fbase.replace(ext, "").split("-")[1:3]
+    return cam, expid, ext
+
+
+def _getDtype(args):
+    return np.float32 if args.float32 else np.float64
+
+
+def validate_float32(f, args):
+    im = fitsio.read(f, ext="IMAGE")
+    powers = [
+        np.vstack(getpower(
+            im, args.nslice, args.mpad, args.mdown, workers=args.nthreads,
+            dtype=dtype))
+        for dtype in (np.float64, np.float32)]
+    print(utils.float32_difference_report(
+        f"powers of {f.split('/')[-1]}", *powers))
+
+
+def one_wrap(f, args):
+    cam, expid, ext = _splitFname(f)
+    if cam is None:
         print("Extension error in", f)
         return None, None, None, None
-    cam, expid = fbase.replace(ext, "").split("-")[1:3]
-    fbase = args.outdir + '/' + fbase
+    fbase = args.outdir + '/' + f.split('/')[-1]
 
     night = fitsio.read_header(f, ext="IMAGE")['NIGHT']
     im = fitsio.read(f, ext="IMAGE")
     if args.save_images:
         save_image(im, fbase.replace(ext, "-image.png"))
 
-    kplist = getpower(im, args.nslice, args.mpad, args.mdown)
+    kplist = getpower(
+        im, args.nslice, args.mpad, args.mdown, workers=args.nthreads,
+        dtype=_getDtype(args))
     kplist = np.vstack(kplist)
-    save_power_image(
-        kplist, args.nslice, f"{night}-{cam}-{expid}",
-        fbase.replace(ext, f"-{night}-p1d-image.png"))
+    if not args.no_plots:
+        save_power_image(
+            kplist, args.nslice, f"{night}-{cam}-{expid}",
+            fbase.replace(ext, f"-{night}-p1d-image.png"))
     return cam, expid, night, kplist
 
 
+def _getOutputFname(args):
+    if args.table_output:
+        return args.outdir + "/preproc-zeros-powers-table.fits"
+    return args.outdir + "/preproc-zeros-powers.fits"
+
+
+def _readExistingPowers(ofname):
+    # Returns (cam, expid, night, kplist) of exposures already saved and
+    # whether the file has to be rewritten, because it holds averages from
+    # a finished run or ends with a truncated HDU.
+    exposures = []
+    needs_rewrite = False
+    try:
+        fts = fitsio.FITS(ofname)
+    except (OSError, ValueError) as e:
+        print(f"Cannot resume from {ofname}: {e}")
+        return exposures, True
+
+    for hdu in fts[1:]:
+        extname = hdu.get_extname()
+        if extname.endswith(_STACK_SUFFIXES):
+            needs_rewrite = True
+            continue
+
+        try:
+            hdr = hdu.read_header()
+            kplist = hdu.read()
+        except (OSError, ValueError):
+            print(f"Dropping unreadable extension {extname}.")
+            needs_rewrite = True
+            break
+
+        exposures.append(
+            (hdr['CAM'].strip(), str(hdr['EXPID']).strip(), hdr['NIGHT'],
+             kplist))
+    fts.close()
+
+    return exposures, needs_rewrite
+
+
+def _writeExposures(ofname, exposures):
+    ftmp = ofname + ".tmp"
+    with fitsio.FITS(ftmp, 'rw', clobber=True) as fts:
+        fts.write(None)
+        for cam, expid, night, kplist in exposures:
+            hdr = {"CAM": cam, "EXPID": expid, "NIGHT": night}
+            fts.write(kplist, header=hdr, extname=f"{night}-{cam}-{expid}")
+    os.replace(ftmp, ofname)
+
+
+def _toTableRows(exposures):
+    # Row 0 of kplist is the k grid, which is saved once in KGRID.
+    shape = exposures[0][3][1:].shape
+    rows = np.empty(len(exposures), dtype=[
+        ('NIGHT', 'i4'), ('CAM', 'U4'), ('EXPID', 'U16'),
+        ('POWER', 'f8', shape)])
+
+    for i, (cam, expid, night, kplist) in enumerate(exposures):
+        if kplist[1:].shape != shape:
+            raise ValueError(
+                f"Power of {cam}-{expid} has shape {kplist[1:].shape}, but "
+                f"the table has {shape}. Use the default output instead.")
+        rows[i] = (night, cam, expid, kplist[1:])
+
+    return rows
+
+
+def _toStackRows(stacks):
+    shape = stacks[0][5][1:].shape
+    rows = np.empty(len(stacks), dtype=[
+        ('NIGHT', 'i4'), ('CAM', 'U4'), ('EXPID', 'U16'),
+        ('NIGHTMIN', 'i4'), ('NIGHTMAX', 'i4'), ('NEXP', 'i4'),
+        ('POWER', 'f8', shape)])
+
+    for i, (cam, kind, night1, night2, nexp, kplist) in enumerate(stacks):
+        rows[i] = (night2, cam, kind, night1, night2, nexp, kplist[1:])
+
+    return rows
+
+
+def _fromTableRows(kgrid, rows):
+    return [
+        (str(r['CAM']).strip(), str(r['EXPID']).strip(), int(r['NIGHT']),
+         np.vstack((kgrid, r['POWER'])))
+        for r in rows]
+
+
+def read_powers_table(fname, cams=None, nights=None, extname="POWERS"):
+    """Reads k grid and powers from the table output.
+
+    Only NIGHT and CAM columns are scanned to select rows, so a camera or
+    a night range is loaded without reading the other power arrays.
+
+    Args:
+        fname (str): preproc-zeros-powers-table.fits file.
+        cams (list(str)): Cameras to keep. All if None.
+        nights (tuple(int, int)): First and last night to keep. All if
+            None.
+        extname (str): POWERS for exposures, AVERAGES for stacks. The
+            stack type is in the EXPID column.
+
+    Returns:
+        kgrid (ndarray): k values.
+        rows (ndarray): Structured array with NIGHT, CAM, EXPID, POWER.
+    """
+    with fitsio.FITS(fname) as fts:
+        kgrid = fts['KGRID'].read()
+        hdu = fts[extname]
+        if cams is None and nights is None:
+            return kgrid, hdu.read()
+
+        meta = hdu.read(columns=['NIGHT', 'CAM'])
+        keep = np.ones(meta.size, dtype=bool)
+        if cams is not None:
+            keep &= np.isin(np.char.strip(meta['CAM']), cams)
+        if nights is not None:
+            keep &= (meta['NIGHT'] >= nights[0]) & (meta['NIGHT'] <= nights[1])
+
+        idx = np.nonzero(keep)[0]
+        if idx.size == 0:
+            return kgrid, hdu.read(rows=[0])[:0]
+        return kgrid, hdu.read(rows=idx)
+
+
+def _readExistingTable(ofname):
+    # Same as _readExistingPowers for the table output. Averages from a
+    # finished run are in their own HDU, so dropping them means rewriting
+    # the file. This is cheap, since the whole POWERS column is one read.
+    try:
+        with fitsio.FITS(ofname) as fts:
+            if "POWERS" not in fts:
+                return [], False
+            needs_rewrite = "AVERAGES" in fts
+        kgrid, rows = read_powers_table(ofname)
+    except (OSError, ValueError) as e:
+        print(f"Cannot resume from {ofname}: {e}")
+        return [], True
+
+    return _fromTableRows(kgrid, rows), needs_rewrite
+
+
+def _writeTable(ofname, exposures):
+    ftmp = ofname + ".tmp"
+    with fitsio.FITS(ftmp, 'rw', clobber=True) as fts:
+        fts.write(None)
+        if exposures:
+            fts.write(exposures[0][3][0], extname="KGRID")
+            fts.write(_toTableRows(exposures), extname="POWERS")
+    os.replace(ftmp, ofname)
+
+
+class PowerHDUWriter():
+    """Writes one image HDU per exposure."""
+
+    def __init__(self, ofname, flush_every):
+        self.fts = fitsio.FITS(ofname, 'rw')
+        self.flush_every = flush_every
+        self.nwritten = 0
+
+    def write(self, cam, expid, night, kplist):
+        hdr = {"CAM": cam, "EXPID": expid, "NIGHT": night}
+        self.fts.write(kplist, header=hdr, extname=f"{night}-{cam}-{expid}")
+        self.nwritten += 1
+        # Flush to disk regularly so a killed job keeps its results
+        if self.nwritten % self.flush_every == 0:
+            self.fts.reopen()
+
+    def writeAverages(self, stacks):
+        for cam, kind, night1, night2, nexp, kplist in stacks:
+            hdr = {"CAM": cam, "EXPID": 0, "NIGHT": night2,
+                   "NIGHTMIN": night1, "NIGHTMAX": night2, "NEXP": nexp}
+            self.fts.write(
+                kplist, header=hdr, extname=f"{night2}-{cam}-{kind}")
+
+    def close(self):
+        self.fts.close()
+
+
+class PowerTableWriter():
+    """Buffers exposures and appends them as rows to the POWERS table."""
+
+    def __init__(self, ofname, flush_every):
+        self.fts = fitsio.FITS(ofname, 'rw')
+        self.flush_every = flush_every
+        self.buffer = []
+
+    def write(self, cam, expid, night, kplist):
+        self.buffer.append((cam, expid, night, kplist))
+        if len(self.buffer) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+
+        rows = _toTableRows(self.buffer)
+        if "POWERS" in self.fts:
+            self.fts["POWERS"].append(rows)
+        else:
+            self.fts.write(self.buffer[0][3][0], extname="KGRID")
+            self.fts.write(rows, extname="POWERS")
+        self.fts.reopen()
+        self.buffer = []
+
+    def writeAverages(self, stacks):
+        self.flush()
+        if stacks:
+            self.fts.write(_toStackRows(stacks), extname="AVERAGES")
+
+    def close(self):
+        self.flush()
+        self.fts.close()
+
+
+# Stack types written next to the exposures. Extension names end with
+# -{kind}. AVE, MED and CLIP are over all nights of a camera, NMED and NCLIP
+# over a single night.
+_STACK_NAMES = {
+    "AVE": "mean", "MED": "median", "CLIP": "clipped-mean",
+    "NMED": "night-median", "NCLIP": "night-clipped-mean"}
+_STACK_SUFFIXES = tuple(f"-{kind}" for kind in _STACK_NAMES)
+
+
+class P2Quantile():
+    """Streaming P^2 estimate of a quantile for every element of an array.
+
+    Jain & Chlamtac (1985). Keeps five markers per element, so memory does
+    not grow with the number of samples.
+    """
+
+    def __init__(self, p, shape):
+        self.p = p
+        self.q = np.empty((5,) + shape)
+        self.n = np.tile(np.arange(5.).reshape(5, *([1] * len(shape))),
+                         (1,) + shape)
+        self.ns = np.array([0, 2 * p, 4 * p, 2 + 2 * p, 4])
+        self.dns = np.array([0, p / 2, p, (1 + p) / 2, 1])
+        self.count = 0
+
+    def add(self, x):
+        if self.count < 5:
+            self.q[self.count] = x
+            self.count += 1
+            if self.count == 5:
+                self.q.sort(axis=0)
+            return
+
+        q, n = self.q, self.n
+        q[0] = np.fmin(q[0], x)
+        q[4] = np.fmax(q[4], x)
+        k = (x >= q[1]).astype(int) + (x >= q[2]) + (x >= q[3])
+        for i in range(1, 5):
+            n[i] += k < i
+        self.ns += self.dns
+        self.count += 1
+
+        for i in range(1, 4):
+            d = self.ns[i] - n[i]
+            move = (((d >= 1) & (n[i + 1] - n[i] > 1))
+                    | ((d <= -1) & (n[i - 1] - n[i] < -1)))
+            if not move.any():
+                continue
+
+            d = np.where(d >= 0, 1., -1.)
+            qp = q[i] + d / (n[i + 1] - n[i - 1]) * (
+                (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+                + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+            qlin = np.where(
+                d > 0,
+                q[i] + (q[i + 1] - q[i]) / (n[i + 1] - n[i]),
+                q[i] - (q[i - 1] - q[i]) / (n[i - 1] - n[i]))
+            qp = np.where((q[i - 1] < qp) & (qp < q[i + 1]), qp, qlin)
+            q[i] = np.where(move, qp, q[i])
+            n[i] += np.where(move, d, 0)
+
+    def get(self):
+        if self.count < 5:
+            return np.quantile(self.q[:self.count], self.p, axis=0)
+        return self.q[2].copy()
+
+
+class RobustStack():
+    """Streaming median and sigma-clipped mean of same-shape arrays.
+
+    The median and the 16th and 84th percentiles are tracked with P^2
+    sketches. A new array contributes to the clipped mean where it is
+    within ``nsigma`` of the current median, with sigma taken from the
+    percentiles. The first five arrays are kept to seed the sketches and
+    are clipped against their own median and MAD.
+    """
+
+    def __init__(self, shape, nsigma=3.):
+        self.nsigma = nsigma
+        self.quantiles = [P2Quantile(p, shape) for p in (0.1587, 0.5, 0.8413)]
+        self.csum = np.zeros(shape)
+        self.cnum = np.zeros(shape, dtype=int)
+        self.nexp = 0
+
+    def _clip(self, x, median, sigma):
+        w = np.abs(x - median) <= self.nsigma * sigma
+        return np.where(w, x, 0), w
+
+    def _clipSeed(self):
+        seed = self.quantiles[1].q[:self.nexp]
+        median = np.median(seed, axis=0)
+        sigma = 1.4826 * np.median(np.abs(seed - median), axis=0)
+        csum, cnum = np.zeros_like(self.csum), np.zeros_like(self.cnum)
+        for x in seed:
+            xw, w = self._clip(x, median, sigma)
+            csum += xw
+            cnum += w
+        return csum, cnum
+
+    def add(self, x):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if self.nexp >= 5:
+                q1, q2, q3 = [qs.get() for qs in self.quantiles]
+                xw, w = self._clip(x, q2, (q3 - q1) / 2)
+                self.csum += xw
+                self.cnum += w
+
+            for qs in self.quantiles:
+                qs.add(x)
+            self.nexp += 1
+
+            if self.nexp == 5:
+                self.csum, self.cnum = self._clipSeed()
+
+    def getMedian(self):
+        return self.quantiles[1].get()
+
+    def getClippedMean(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if self.nexp < 5:
+                # Not seeded yet, clip the arrays in hand.
+                csum, cnum = self._clipSeed()
+                return csum / cnum
+            return self.csum / self.cnum
+
+
+class PowerStacks():
+    """Plain and robust stacks of powers per camera and per camera-night.
+
+    Memory is bounded by the number of cameras and nights, not exposures.
+    """
+
+    def __init__(self, nsigma=3.):
+        self.nsigma = nsigma
+        self.sums = {}
+        self.nights = {}
+        self.by_cam = {}
+        self.by_night = {}
+
+    def _getRobust(self, stacks, key, shape):
+        if key not in stacks:
+            stacks[key] = RobustStack(shape, self.nsigma)
+        return stacks[key]
+
+    def add(self, cam, night, kplist):
+        night = int(night)
+        if cam not in self.sums:
+            self.sums[cam] = [kplist.copy(), 1]
+            self.nights[cam] = [night, night]
+        else:
+            self.sums[cam][0] += kplist
+            self.sums[cam][1] += 1
+            self.nights[cam][0] = min(self.nights[cam][0], night)
+            self.nights[cam][1] = max(self.nights[cam][1], night)
+
+        self._getRobust(self.by_cam, cam, kplist.shape).add(kplist)
+        self._getRobust(self.by_night, (cam, night), kplist.shape).add(
+            kplist)
+
+    def getStacks(self):
+        """Returns a list of (cam, kind, nightmin, nightmax, nexp, kplist).
+        """
+        stacks = []
+        for cam in sorted(self.sums):
+            kplist, nj = self.sums[cam]
+            night1, night2 = self.nights[cam]
+            robust = self.by_cam[cam]
+            stacks.append((cam, "AVE", night1, night2, nj, kplist / nj))
+            stacks.append(
+                (cam, "MED", night1, night2, nj, robust.getMedian()))
+            stacks.append(
+                (cam, "CLIP", night1, night2, nj, robust.getClippedMean()))
+
+        for (cam, night) in sorted(self.by_night):
+            robust = self.by_night[(cam, night)]
+            stacks.append(
+                (cam, "NMED", night, night, robust.nexp, robust.getMedian()))
+            stacks.append((cam, "NCLIP", night, night, robust.nexp,
+                           robust.getClippedMean()))
+
+        return stacks
+
+
+def _getStackPlotFname(ofname, night, cam, kind):
+    return ofname.replace(
+        ".fits", f"-{night}-{cam}-{_STACK_NAMES[kind]}-p1d-image.png")
+
+
+def _selectForRender(hdr, extname, args):
+    if args.render_cams and hdr['CAM'].strip() not in args.render_cams:
+        return False
+    if args.render_nights:
+        night1, night2 = args.render_nights
+        if not (night1 <= int(hdr['NIGHT']) <= night2):
+            return False
+
+    is_stack = extname.endswith(_STACK_SUFFIXES)
+    return is_stack or not args.means_only
+
+
+def _renderOne(nslice, item):
+    kplist, title, fname = item
+    save_power_image(kplist, nslice, title, fname)
+    return fname
+
+
+def _readForRender(ofname, args):
+    # Powers are small, so they are read once here and shipped to workers
+    # instead of reopening a file with thousands of HDUs in every worker.
+    items = []
+    with fitsio.FITS(ofname) as fts:
+        for hdu in fts[1:]:
+            extname = hdu.get_extname()
+            hdr = hdu.read_header()
+            if not _selectForRender(hdr, extname, args):
+                continue
+
+            cam, night = hdr['CAM'].strip(), hdr['NIGHT']
+            if extname.endswith(_STACK_SUFFIXES):
+                kind = extname.split("-")[-1]
+                title = f"{night}-{cam}-{_STACK_NAMES[kind]}"
+                fname = _getStackPlotFname(ofname, night, cam, kind)
+            else:
+                expid = str(hdr['EXPID']).strip()
+                title = f"{night}-{cam}-{expid}"
+                fname = (f"{args.outdir}/preproc-{cam}-{expid}-{night}"
+                         "-p1d-image.png")
+            items.append((hdu.read(), title, fname))
+
+    return items
+
+
+def _readTableForRender(ofname, args):
+    items = []
+    if not args.means_only:
+        kgrid, rows = read_powers_table(
+            ofname, args.render_cams, args.render_nights)
+        for cam, expid, night, kplist in _fromTableRows(kgrid, rows):
+            fname = (f"{args.outdir}/preproc-{cam}-{expid}-{night}"
+                     "-p1d-image.png")
+            items.append((kplist, f"{night}-{cam}-{expid}", fname))
+
+    with fitsio.FITS(ofname) as fts:
+        has_averages = "AVERAGES" in fts
+    if not has_averages:
+        return items
+
+    kgrid, rows = read_powers_table(
+        ofname, args.render_cams, args.render_nights, extname="AVERAGES")
+    for cam, kind, night, kplist in _fromTableRows(kgrid, rows):
+        items.append((kplist, f"{night}-{cam}-{_STACK_NAMES[kind]}",
+                      _getStackPlotFname(ofname, night, cam, kind)))
+
+    return items
+
+
+def render(args):
+    ofname = _getOutputFname(args)
+    if args.table_output:
+        items = _readTableForRender(ofname, args)
+    else:
+        items = _readForRender(ofname, args)
+    print(f"Rendering {len(items)} power images.")
+
+    with Pool(processes=args.nproc) as pool:
+        imap_it = pool.imap_unordered(
+            functools.partial(_renderOne, args.nslice), items, chunksize=4)
+        for _ in tqdm(imap_it, total=len(items)):
+            pass
+
+
 def main(options=None):
     args = parse(options)
+    if args.render:
+        render(args)
+        return
+
     flist = args.infiles
     makedirs(args.outdir, exist_ok=True)
 
-    ofname = args.outdir + "/preproc-zeros-powers.fits"
-    fitsio.write(ofname, None, clobber=True)
+    ofname = _getOutputFname(args)
+    if args.table_output:
+        read_existing, rewrite, Writer = (
+            _readExistingTable, _writeTable, PowerTableWriter)
+    else:
+        read_existing, rewrite, Writer = (
+            _readExistingPowers, _writeExposures, PowerHDUWriter)
+
+    stacks = PowerStacks(args.clip_nsigma)
+
+    if args.resume and os.path.exists(ofname):
+        exposures, needs_rewrite = read_existing(ofname)
+        if needs_rewrite:
+            rewrite(ofname, exposures)
 
+        done = set()
+        for cam, expid, night, kplist in exposures:
+            done.add((cam, expid))
+            stacks.add(cam, night, kplist)
+
+        flist = [f for f in flist if _splitFname(f)[:2] not in done]
+        print(f"Resuming: {len(exposures)} exposures already saved, "
+              f"{len(flist)} remaining.")
+    else:
+        fitsio.write(ofname, None, clobber=True)
+
+    if args.float32 and flist:
+        validate_float32(flist[0], args)
+
+    writer = Writer(ofname, args.flush_every)
     with Pool(processes=args.nproc) as pool:
         inputs = [(f, args) for f in flist]
-        results = pool.starmap(one_wrap, inputs)
+        imap_it = utils.imap_balanced(
+            pool, one_wrap, inputs, utils.get_file_sizes(flist), args.nproc,
+            star=True)
 
-    results_dict = {}
-    for cam, expid, night, kplist in tqdm(results):
-        if cam is None:
-            continue
-        if cam not in results_dict:
-            results_dict[cam] = [kplist.copy(), 1]
-        else:
-            results_dict[cam][0] += kplist
-            results_dict[cam][1] += 1
+        for _, result in tqdm(imap_it, total=len(inputs)):
+            cam, expid, night, kplist = result
+            if cam is None:
+                continue
 
-        hdr = {"CAM": cam, "EXPID": expid, "NIGHT": night}
-        fitsio.write(
-            ofname, kplist, header=hdr, extname=f"{night}-{cam}-{expid}")
+            stacks.add(cam, night, kplist)
+            writer.write(cam, expid, night, kplist)
 
-    for cam, (kplist, nj) in results_dict.items():
-        kplist /= nj
-        save_power_image(
-            kplist, args.nslice, f"{night}-{cam}-mean",
-            ofname.replace(".fits", f"-{night}-{cam}-mean-p1d-image.png"))
-        hdr = {"CAM": cam, "EXPID": 0, "NIGHT": night}
-        fitsio.write(
-            ofname, kplist, header=hdr, extname=f"{night}-{cam}-AVE")
+    stacks = stacks.getStacks()
+    for cam, kind, _, night, _, kplist in stacks:
+        if not args.no_plots and kind == "AVE":
+            save_power_image(
+                kplist, args.nslice, f"{night}-{cam}-mean",
+                _getStackPlotFname(ofname, night, cam, kind))
+
+    writer.writeAverages(stacks)
+    writer.close()
@@ -1,7 +1,12 @@
 import argparse
+import copy
+import hashlib
 import logging
-from multiprocessing import Pool
+from multiprocessing import Pool, cpu_count
+import os
+import pickle
 
+import fitsio
 import numpy as np
 from tqdm import tqdm
 
@@ -10,10 +15,14 @@ from qsotools.io import Spectrum, PiccaFile, ConfigQMLE
 import qsotools.fiducial as fid
 import qsotools.utils as qutil
 
+from desi_y1_p1d import utils
+
 ZQSO_SHIFT = 0.2
 
 
-def _readSpectrum(hdu):
+def _readDeltaColumns(hdu, dtype=None):
+    # Wavelengths stay in double precision for binning. dtype casts delta,
+    # error and weight.
     hdr = hdu.read_header()
     data = hdu.read()
 
@@ -33,53 +42,481 @@ def _readSpectrum(hdu):
     else:
         weight = data['IVAR']
 
-    specres = fid.LIGHT_SPEED / hdr['MEANRESO'] / fid.ONE_SIGMA_2_FWHM
-    if 'DLL' in hdr.keys():
-        dv = hdr['DLL'] * fid.LIGHT_SPEED * np.log(10)
+    if dtype is not None:
+        delta = delta.astype(dtype, copy=False)
+        error = error.astype(dtype, copy=False)
+        weight = weight.astype(dtype, copy=False)
+
+    return hdr, wave, delta, error, weight
+
+
+def _getTargetid(hdr, hdu):
+    # Older delta files only have THING_ID
+    for key in ['TARGETID', 'THING_ID']:
+        if key in hdr:
+            return hdr[key]
+
+    raise KeyError(
+        "Subsampling by targetid needs TARGETID or THING_ID in the header "
+        f"of HDU {hdu.get_extnum()} of {hdu.get_filename()}. Use "
+        "--subsample-by healpix instead.")
+
+
+def _readPiccaFile(
+        pfile, hdus, no_weights=False, dtype=None, read_targetid=False
+):
+    # Concatenates pixels of all forests in hdus into one flat spectrum.
+    # Per-forest z_qso, MEANSNR and number of pixels are returned as arrays,
+    # and TARGETID if read_targetid (None otherwise).
+    nforests = len(hdus)
+    z_qso = np.empty(nforests)
+    meansnr = np.empty(nforests)
+    targetid = None
+    if read_targetid:
+        targetid = np.empty(nforests, dtype=np.int64)
+    npixels = np.empty(nforests, dtype=int)
+    waves, deltas, errors, weights = [], [], [], []
+
+    for i, hdu in enumerate(hdus):
+        fhdu = pfile.fitsfile[hdu]
+        hdr, wave, delta, error, weight = _readDeltaColumns(fhdu, dtype)
+        z_qso[i] = hdr['Z']
+        meansnr[i] = hdr['MEANSNR']
+        if read_targetid:
+            targetid[i] = _getTargetid(hdr, fhdu)
+        npixels[i] = wave.size
+        waves.append(wave)
+        deltas.append(delta)
+        errors.append(error)
+        weights.append(weight)
+
+    wave = np.concatenate(waves)
+    if no_weights:
+        weight = np.ones(wave.size, dtype=dtype)
     else:
-        dv = hdr['MEANRESO']
-    reso_rkms = None
+        weight = np.concatenate(weights)
+
+    # Mean flux binning is per pixel, so a single spectrum with all pixels
+    # fills the redshift histogram in one pass. Resolution is not used.
     qso = Spectrum(
-        wave, delta, error, hdr['Z'], specres, dv,
-        {'RA': hdr['RA'], 'DEC': hdr['DEC']}, reso_rkms)
+        wave, np.concatenate(deltas), np.concatenate(errors),
+        z_qso.max(), 1., 1., {'RA': 0., 'DEC': 0.}, None)
+
+    return qso, weight, z_qso, meansnr, targetid, npixels
+
+
+class WeightedMoments():
+    # Weighted mean and scatter per bin. Partial results are merged with the
+    # pairwise (Chan et al.) update of Welford's algorithm, so per-rank and
+    # per-chunk moments combine without cancellation in sum(x^2) - sum(x)^2.
+    def __init__(self, nbins):
+        self.wsum = np.zeros(nbins)
+        self.mean = np.zeros(nbins)
+        self.m2 = np.zeros(nbins)
+
+    def _merge(self, wsum, mean, m2):
+        total = self.wsum + wsum
+        frac = np.divide(
+            wsum, total, out=np.zeros_like(total), where=total > 0)
+        diff = mean - self.mean
+        self.mean += diff * frac
+        self.m2 += m2 + diff**2 * self.wsum * frac
+        self.wsum = total
+
+    def add(self, idx, x, w):
+        n = self.wsum.size
+        wsum = np.bincount(idx, weights=w, minlength=n)
+        mean = np.bincount(idx, weights=w * x, minlength=n)
+        mean = np.divide(mean, wsum, out=np.zeros(n), where=wsum > 0)
+        m2 = np.bincount(idx, weights=w * (x - mean[idx])**2, minlength=n)
+        self._merge(wsum, mean, m2)
+
+    def __iadd__(self, other):
+        self._merge(other.wsum, other.mean, other.m2)
+        return self
+
+    def getScatter(self):
+        var = np.divide(
+            self.m2, self.wsum, out=np.zeros_like(self.m2),
+            where=self.wsum > 0)
+        return np.sqrt(var)
+
+
+class StableMeanFluxHist(MeanFluxHist):
+    """MeanFluxHist with a numerically stable scatter of delta.
+
+    The base class sums w x^2 and takes sqrt(<x^2> - <x>^2), which cancels
+    once partial histograms of many chunks or ranks are added. Here
+    per-bin weighted moments of the same pixels are accumulated next to the
+    base sums and merged pairwise in ``+=``. ``saveHistograms`` writes
+    their scatter to its own file next to the base class outputs.
+    """
+
+    def __init__(self, z1, z2, dz):
+        super().__init__(z1, z2, dz)
+        self.moments = WeightedMoments(self.nz + 2)
+
+    @staticmethod
+    def _selectPixels(qso, weight, f1, f2):
+        # Pixels the base class bins: rest-frame wavelengths in [f1, f2) of
+        # qso.z_qso and a positive error.
+        wave_rf = qso.wave / (1 + qso.z_qso)
+        good = (qso.error > 0) & (wave_rf >= f1) & (wave_rf < f2)
+        return weight * good
+
+    def addSpectrum(self, qso, weight, f1=0, f2=9000, compute_scatter=False):
+        super().addSpectrum(
+            qso, weight, f1=f1, f2=f2, compute_scatter=compute_scatter)
+        if not compute_scatter:
+            return
 
-    return qso, weight, hdr['MEANSNR']
+        z = qso.wave / fid.LYA_WAVELENGTH - 1
+        idx = np.searchsorted(self.hist_redshift_edges, z)
+        self.moments.add(
+            idx, qso.flux, self._selectPixels(qso, weight, f1, f2))
+
+    def __iadd__(self, other):
+        self.moments += other.moments
+        return super().__iadd__(other)
+
+    def saveHistograms(self, output_base):
+        super().saveHistograms(output_base)
+        np.savetxt(
+            f"{output_base}-meandelta-scatter.csv",
+            (self.hist_redshifts, self.moments.getScatter()[1:-1]))
+
+
+def _hashTargetid(targetid, nsubsamples):
+    # Fibonacci hashing decorrelates groups from TARGETID bit patterns.
+    h = targetid.astype(np.uint64) * np.uint64(11400714819323198485)
+    return ((h >> np.uint64(32)) % np.uint64(nsubsamples)).astype(int)
+
+
+def _getHealpixFromFname(fname):
+    base = os.path.basename(fname).split('.')[0]
+    pix = base.split('-')[-1]
+    if pix.isdigit():
+        return int(pix)
+
+    return int(hashlib.sha1(base.encode()).hexdigest()[:8], 16)
+
+
+class SubsampleSums():
+    # Per-subsample weight and weighted delta sums in redshift bins. Mean
+    # flux errors are resampled from these K partial sums after the pass.
+    def __init__(self, nsubsamples, nbins):
+        self.wsum = np.zeros((nsubsamples, nbins))
+        self.wxsum = np.zeros((nsubsamples, nbins))
+
+    def add(self, isub, idx, x, w):
+        k, n = self.wsum.shape
+        flat = isub * n + idx
+        self.wsum += np.bincount(flat, weights=w, minlength=k * n).reshape(k, n)
+        self.wxsum += np.bincount(
+            flat, weights=w * x, minlength=k * n).reshape(k, n)
+
+    def __iadd__(self, other):
+        self.wsum += other.wsum
+        self.wxsum += other.wxsum
+        return self
+
+    @staticmethod
+    def _mean(wxsum, wsum):
+        return np.divide(
+            wxsum, wsum, out=np.zeros_like(wxsum), where=wsum > 0)
+
+    def getJackknifeCov(self):
+        k = self.wsum.shape[0]
+        means = self._mean(
+            self.wxsum.sum(axis=0) - self.wxsum,
+            self.wsum.sum(axis=0) - self.wsum)
+        means -= means.mean(axis=0)
+        return (k - 1) / k * (means.T @ means)
+
+    def getBootstrapCov(self, nboot, seed=0):
+        k = self.wsum.shape[0]
+        rng = np.random.default_rng(seed)
+        counts = rng.multinomial(k, np.full(k, 1. / k), size=nboot)
+        means = self._mean(counts @ self.wxsum, counts @ self.wsum)
+        means -= means.mean(axis=0)
+        return means.T @ means / (nboot - 1)
+
+
+class SparseHistogram():
+    # N-dimensional histogram that stores only occupied bins as sorted flat
+    # indices and counts. Values outside the edges are dropped.
+    def __init__(self, edges, axis_names):
+        self.edges = edges
+        self.axis_names = axis_names
+        self.shape = tuple(e.size - 1 for e in edges)
+        self.keys = np.empty(0, dtype=np.int64)
+        self.counts = np.empty(0)
+
+    def _merge(self, keys, counts):
+        keys = np.concatenate((self.keys, keys))
+        counts = np.concatenate((self.counts, counts))
+        self.keys, inv = np.unique(keys, return_inverse=True)
+        self.counts = np.bincount(inv.ravel(), weights=counts)
+
+    def add(self, *values):
+        idx = [np.searchsorted(e, v, side='right') - 1
+               for e, v in zip(self.edges, values)]
+        w = np.logical_and.reduce(
+            [(i >= 0) & (i < n) for i, n in zip(idx, self.shape)])
+        flat = np.ravel_multi_index([i[w] for i in idx], self.shape)
+        keys, counts = np.unique(flat, return_counts=True)
+        self._merge(keys, counts.astype(float))
+
+    def __iadd__(self, other):
+        self._merge(other.keys, other.counts)
+        return self
+
+    def toDense(self):
+        cube = np.zeros(self.shape)
+        cube.flat[self.keys] = self.counts
+        return cube
+
+    def write(self, fname):
+        hdr = {'AXES': ','.join(self.axis_names), 'NBINS': self.keys.size}
+        with fitsio.FITS(fname, 'rw', clobber=True) as fts:
+            fts.write(self.toDense(), header=hdr, extname='CUBE')
+            for name, e in zip(self.axis_names, self.edges):
+                fts.write(e, extname=f"{name}_EDGES")
 
 
 class CalculateStats():
     def _find_zqso_indx(self, z_qso):
         idx = np.searchsorted(
             self.local_meanflux_hist.hist_redshift_edges + ZQSO_SHIFT, z_qso)
-        self.local_zqso_hist[idx] += 1
+        self.local_zqso_hist += np.bincount(
+            idx, minlength=self.local_zqso_hist.size)
 
     def _add_snr_hist(self, snr):
-        idx = min(int(snr / self.dsnr), self.local_meansnr_hist.size - 1)
-        self.local_meansnr_hist[idx] += 1
+        idx = np.minimum(
+            (snr / self.dsnr).astype(int), self.local_meansnr_hist.size - 1)
+        # add.at keeps negative index wrap-around for negative MEANSNR
+        np.add.at(self.local_meansnr_hist, idx, 1)
 
-    def __init__(self, args, config_qmle):
-        self.config_qmle = config_qmle
-        self.local_meanflux_hist = MeanFluxHist(args.z1, args.z2, args.dz)
+    def _reset(self):
+        self.local_meanflux_hist = StableMeanFluxHist(
+            self.z1, self.z2, self.dz)
         self.local_zqso_hist = np.zeros(self.local_meanflux_hist.nz + 2)
-        self.local_meansnr_hist = np.zeros(args.nsnr)
+        self.local_meansnr_hist = np.zeros(self.nsnr)
+        self.local_cube = None
+        if self.cube_args is not None:
+            self.local_cube = self._createCube()
+        self.local_subsamples = None
+        if self.nsubsamples > 0:
+            self.local_subsamples = SubsampleSums(
+                self.nsubsamples, self.local_meanflux_hist.nz + 2)
+        self.ncached = 0
+
+    def _createCube(self):
+        rfw1, rfw2, drfw = self.cube_args
+        z_edges = self.local_meanflux_hist.hist_redshift_edges
+        # Last SNR bin collects overflow like the MEANSNR histogram
+        snr_edges = np.append(np.arange(self.nsnr) * self.dsnr, np.inf)
+        rfw_edges = np.arange(rfw1, rfw2 + drfw / 2, drfw)
+        return SparseHistogram(
+            [z_edges, snr_edges, rfw_edges, z_edges + ZQSO_SHIFT],
+            ['ZPIX', 'MEANSNR', 'RFWAVE', 'ZQSO'])
+
+    def __init__(self, args, qso_dir, cache_dir=None):
+        self.qso_dir = qso_dir
+        self.cache_dir = cache_dir
+        self.z1, self.z2, self.dz = args.z1, args.z2, args.dz
+        self.nsnr = args.nsnr
         self.dsnr = args.dsnr
         self.no_weights = args.no_weights
-        self.fdelta = None
+        self.cube_args = None
+        if args.cube:
+            self.cube_args = (args.rfw1, args.rfw2, args.drfw)
+        self.nsubsamples = args.nsubsamples
+        self.subsample_by = args.subsample_by
+        # Pixel arrays are float32, but all sums are float64 through
+        # bincount and the histograms.
+        self.dtype = np.float32 if args.float32 else None
+        self._reset()
 
-    def __call__(self, fnames):
+    def __iadd__(self, other):
+        self.local_meanflux_hist += other.local_meanflux_hist
+        self.local_zqso_hist += other.local_zqso_hist
+        self.local_meansnr_hist += other.local_meansnr_hist
+        if self.local_cube is not None:
+            self.local_cube += other.local_cube
+        if self.local_subsamples is not None:
+            self.local_subsamples += other.local_subsamples
+        self.ncached += other.ncached
+        return self
+
+    def _cacheFname(self, f, hdus):
+        st = os.stat(f)
+        key = (os.path.abspath(f), st.st_size, st.st_mtime_ns, tuple(hdus),
+               self.z1, self.z2, self.dz, self.nsnr, self.dsnr,
+               self.no_weights, self.cube_args, self.nsubsamples,
+               self.subsample_by, self.dtype,
+               type(self.local_meanflux_hist).__name__)
+        key = hashlib.sha1(repr(key).encode()).hexdigest()
+        return f"{self.cache_dir}/{key}.pkl"
+
+    def _addFileCached(self, f, hdus):
+        fcache = self._cacheFname(f, hdus)
+        if os.path.exists(fcache):
+            with open(fcache, 'rb') as fp:
+                self += pickle.load(fp)
+            self.ncached += 1
+            return
+
+        partial = copy.copy(self)
+        partial._reset()
+        partial.cache_dir = None
+        partial._addFile(f, hdus)
+
+        # Write to a unique name first so concurrent or killed workers
+        # never leave a partial pickle behind.
+        ftmp = f"{fcache}.{os.getpid()}.tmp"
+        with open(ftmp, 'wb') as fp:
+            pickle.dump(partial, fp)
+        os.replace(ftmp, fcache)
+
+        self += partial
+
+    def addFile(self, fnames):
         base, hdus = fnames
-        f = f"{self.config_qmle.qso_dir}/{base}"
+        if not hdus:
+            return
+
+        f = f"{self.qso_dir}/{base}"
+        if self.cache_dir:
+            self._addFileCached(f, hdus)
+        else:
+            self._addFile(f, hdus)
+
+    def _addFile(self, f, hdus):
         pfile = PiccaFile(f, 'r')
-        for hdu in hdus:
-            qso, weight, meansnr = _readSpectrum(pfile.fitsfile[hdu])
-            if self.no_weights:
-                weight = 1
-            self.local_meanflux_hist.addSpectrum(
-                qso, weight, f1=0, f2=9000, compute_scatter=True)
-            self._find_zqso_indx(qso.z_qso)
-            self._add_snr_hist(meansnr)
+        read_targetid = (
+            self.nsubsamples > 0 and self.subsample_by == "targetid")
+        qso, weight, z_qso, meansnr, targetid, npixels = _readPiccaFile(
+            pfile, hdus, self.no_weights, self.dtype, read_targetid)
+        pfile.close()
+
+        self.local_meanflux_hist.addSpectrum(
+            qso, weight, f1=0, f2=9000, compute_scatter=True)
+        self._find_zqso_indx(z_qso)
+        self._add_snr_hist(meansnr)
+
+        z = qso.wave / fid.LYA_WAVELENGTH - 1
+        idx = np.searchsorted(self.local_meanflux_hist.hist_redshift_edges, z)
+
+        if self.local_cube is not None:
+            w = qso.error > 0
+            z_qso_pix = np.repeat(z_qso, npixels)[w]
+            self.local_cube.add(
+                z[w], np.repeat(meansnr, npixels)[w],
+                qso.wave[w] / (1 + z_qso_pix), z_qso_pix)
+
+        if self.local_subsamples is not None:
+            if self.subsample_by == "healpix":
+                isub = np.full(
+                    qso.wave.size, _getHealpixFromFname(f) % self.nsubsamples)
+            else:
+                isub = np.repeat(
+                    _hashTargetid(targetid, self.nsubsamples), npixels)
+            self.local_subsamples.add(
+                isub, idx, qso.flux, weight * (qso.error > 0))
+
+    def __call__(self, chunk):
+        # Every task starts from empty accumulators and sends them back
+        # exactly once, after all files in its chunk are added.
+        self._reset()
+        for fnames in chunk:
+            self.addFile(fnames)
+
+        return self
+
+
+def _treeReduce(comm, stats):
+    # Binomial tree: at every level odd partners send to their left
+    # neighbour, so rank 0 ends up with the total in log2(size) steps.
+    rank, size = comm.Get_rank(), comm.Get_size()
+    step = 1
+    while step < size:
+        if rank % (2 * step) == step:
+            comm.send(stats, dest=rank - step, tag=step)
+            return None
+        if rank + step < size:
+            stats += comm.recv(source=rank + step, tag=step)
+        step *= 2
+
+    return stats
+
+
+def _runMPI(args, qso_dir, fnames_spectra, cache_dir=None):
+    from mpi4py import MPI
+
+    comm = MPI.COMM_WORLD
+    rank, size = comm.Get_rank(), comm.Get_size()
+    local_fnames = fnames_spectra[rank::size]
+    if rank == 0:
+        logging.info(
+            f"Distributing {len(fnames_spectra)} files over {size} ranks.")
+        if args.float32:
+            validate_float32(args, qso_dir, fnames_spectra)
+
+    stats = CalculateStats(args, qso_dir, cache_dir)
+    for fnames in tqdm(local_fnames, disable=rank != 0):
+        stats.addFile(fnames)
+
+    return _treeReduce(comm, stats)
+
 
-        return (self.local_meanflux_hist, self.local_zqso_hist,
-                self.local_meansnr_hist)
+def validate_float32(args, qso_dir, fnames_spectra):
+    # Compares statistics of the first file in double and single precision.
+    fnames = next((x for x in fnames_spectra if x[1]), None)
+    if fnames is None:
+        return
+
+    stats = {}
+    for dtype in (None, np.float32):
+        stats[dtype] = CalculateStats(args, qso_dir)
+        stats[dtype].dtype = dtype
+        stats[dtype].addFile(fnames)
+
+    ref = stats[None].local_meanflux_hist.moments
+    test = stats[np.float32].local_meanflux_hist.moments
+    label = f"mean delta of {fnames[0]}"
+    logging.info(utils.float32_difference_report(label, ref.mean, test.mean))
+    label = f"delta scatter of {fnames[0]}"
+    logging.info(utils.float32_difference_report(
+        label, ref.getScatter(), test.getScatter()))
+
+
+def _runPool(args, qso_dir, fnames_spectra, cache_dir=None):
+    nproc = args.nproc if args.nproc else cpu_count()
+    sizes = utils.get_file_sizes(
+        [f"{qso_dir}/{base}" for base, _ in fnames_spectra])
+    chunks = utils.split_balanced(
+        fnames_spectra, sizes, nproc * args.chunks_per_proc)
+    logging.info(
+        f"Distributing {len(fnames_spectra)} files in {len(chunks)} chunks.")
+    if args.float32:
+        validate_float32(args, qso_dir, fnames_spectra)
+
+    chunk_stats = [None] * len(chunks)
+    with Pool(processes=nproc) as pool:
+        imap_it = utils.imap_balanced(
+            pool, CalculateStats(args, qso_dir, cache_dir),
+            [chunk for chunk, _ in chunks], [size for _, size in chunks],
+            nproc)
+        for i, cstats in tqdm(imap_it, total=len(chunks)):
+            chunk_stats[i] = cstats
+
+    # Reduce in a fixed order so the result is independent of scheduling.
+    stats = CalculateStats(args, qso_dir)
+    for cstats in chunk_stats:
+        stats += cstats
+
+    return stats
 
 
 def main():
@@ -100,6 +537,48 @@ def main():
         "--no-weights", help="Disable weighting. Useful for mean flux",
         action="store_true")
     parser.add_argument("--nproc", type=int, default=None)
+    parser.add_argument(
+        "--chunks-per-proc", type=int, default=4,
+        help="Number of file chunks per process. Each chunk returns its "
+             "histograms once.")
+    parser.add_argument(
+        "--mpi", action="store_true",
+        help="Distribute files over MPI ranks instead of a process pool.")
+    parser.add_argument(
+        "--use-cache", action="store_true",
+        help="Cache per-file histograms and reuse them for unchanged files.")
+    parser.add_argument(
+        "--cache-dir",
+        help="Cache directory. Default: OutputDir/.{fbase}-cache")
+    parser.add_argument(
+        "--cube", action="store_true",
+        help="Also save the joint pixel z x MEANSNR x rest-frame wavelength "
+             "x z_qso histogram of unmasked pixels as a FITS cube.")
+    parser.add_argument(
+        "--rfw1", help="Lower rest-frame wavelength edge of the cube",
+        default=1040., type=float)
+    parser.add_argument(
+        "--rfw2", help="Upper rest-frame wavelength edge of the cube",
+        default=1200., type=float)
+    parser.add_argument(
+        "--drfw", help="Rest-frame wavelength bin size of the cube",
+        default=5., type=float)
+    parser.add_argument(
+        "--nsubsamples", type=int, default=0,
+        help="Number of subsamples for jackknife and bootstrap covariance "
+             "of the mean delta. Disabled if 0.")
+    parser.add_argument(
+        "--subsample-by", choices=["targetid", "healpix"],
+        default="targetid", help="Assign forests to subsamples by TARGETID "
+                                 "hash or by healpix of the delta file.")
+    parser.add_argument(
+        "--nbootstrap", type=int, default=1000,
+        help="Number of bootstrap realizations.")
+    parser.add_argument("--seed", type=int, default=0, help="Bootstrap seed.")
+    parser.add_argument(
+        "--float32", action="store_true",
+        help="Keep pixel arrays in single precision. Sums are still in "
+             "double precision.")
     args = parser.parse_args()
     logging.basicConfig(level=logging.DEBUG)
 
@@ -120,18 +599,27 @@ def main():
     logging.info("Decomposing filenames to a list of (base, list(hdus)).")
     fnames_spectra = qutil.getPiccaFList(fnames_spectra)
 
-    nfiles = len(fnames_spectra)
+    cache_dir = None
+    if args.use_cache:
+        cache_dir = args.cache_dir or f"{output_dir}/.{args.fbase}-cache"
+        os.makedirs(cache_dir, exist_ok=True)
+        logging.info(f"Using per-file histogram cache in {cache_dir}.")
+
+    if args.mpi:
+        stats = _runMPI(args, config_qmle.qso_dir, fnames_spectra, cache_dir)
+        if stats is None:
+            return
+    else:
+        stats = _runPool(
+            args, config_qmle.qso_dir, fnames_spectra, cache_dir)
 
-    meanflux_hist = MeanFluxHist(args.z1, args.z2, args.dz)
-    zqso_hist = np.zeros(meanflux_hist.nz + 2)
-    meansnr_hist = np.zeros(args.nsnr)
+    if cache_dir:
+        logging.info(
+            f"{stats.ncached} of {len(fnames_spectra)} files read from cache.")
 
-    with Pool(processes=args.nproc) as pool:
-        imap_it = pool.imap(CalculateStats(args, config_qmle), fnames_spectra)
-        for mfh, zqh, msnrh in tqdm(imap_it, total=nfiles):
-            meanflux_hist += mfh
-            zqso_hist += zqh
-            meansnr_hist += msnrh
+    meanflux_hist = stats.local_meanflux_hist
+    zqso_hist = stats.local_zqso_hist
+    meansnr_hist = stats.local_meansnr_hist
 
     meanflux_hist.getMeanStatistics(compute_scatter=True)
     meanflux_hist.saveHistograms(output_base)
@@ -140,6 +628,17 @@ def main():
         f"{output_base}-zqso-hist.csv",
         (meanflux_hist.hist_redshifts + ZQSO_SHIFT, zqso_hist[1:-1]))
 
+    if stats.local_subsamples is not None:
+        logging.info("Calculating jackknife and bootstrap covariances.")
+        cov = stats.local_subsamples.getJackknifeCov()[1:-1, 1:-1]
+        np.savetxt(f"{output_base}-meandelta-jackknife-cov.txt", cov)
+        cov = stats.local_subsamples.getBootstrapCov(
+            args.nbootstrap, args.seed)[1:-1, 1:-1]
+        np.savetxt(f"{output_base}-meandelta-bootstrap-cov.txt", cov)
+
+    if stats.local_cube is not None:
+        stats.local_cube.write(f"{output_base}-joint-cube.fits")
+
     snrcenters = np.arange(args.nsnr) * args.dsnr + (args.dsnr / 2)
     np.savetxt(
         f"{output_base}-forest-meansnr-hist.csv", (snrcenters, meansnr_hist))
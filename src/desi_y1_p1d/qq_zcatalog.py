@@ -9,6 +9,8 @@ from tqdm import tqdm
 
 from numpy.lib.recfunctions import rename_fields, join_by, drop_fields
 
+from desi_y1_p1d import utils
+
 
 final_dtype = np.dtype([
     ('CHI2', 'f8'), ('COEFF', 'f8', 4), ('Z', 'f8'), ('ZERR', 'f8'),
@@ -144,17 +146,27 @@ def main(options=None):
 
     print("Iterating over files.")
     with Pool(processes=args.nproc) as pool:
-        imap_it = pool.imap(one_zcatalog, all_zbests)
-
-        for arr in tqdm(imap_it, total=len(all_zbests), desc="zcat"):
+        imap_it = utils.imap_balanced(
+            pool, one_zcatalog, all_zbests,
+            utils.get_file_sizes(all_zbests), args.nproc)
+        results = utils.collect_in_order(
+            tqdm(imap_it, total=len(all_zbests), desc="zcat"),
+            len(all_zbests))
+
+        for arr in results:
             if arr is None:
                 continue
 
             zcat_list.append(arr)
 
-        imap_it = pool.imap(one_truth_catalog, all_truths)
+        imap_it = utils.imap_balanced(
+            pool, one_truth_catalog, all_truths,
+            utils.get_file_sizes(all_truths), args.nproc)
+        results = utils.collect_in_order(
+            tqdm(imap_it, total=len(all_truths), desc="truth"),
+            len(all_truths))
 
-        for dla_out, bal_out in tqdm(imap_it, total=len(all_truths), desc="truth"):
+        for dla_out, bal_out in results:
             if dla_out is not None:
                 dlacat_list.append(dla_out)
 
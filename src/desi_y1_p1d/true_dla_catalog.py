@@ -5,6 +5,8 @@ from multiprocessing import Pool
 import numpy as np
 import fitsio
 
+from desi_y1_p1d import utils
+
 final_dtype = np.dtype([
     ('NHI', 'f8'), ('Z', 'f8'), ('TARGETID', 'i8'), ('DLAID', 'i8')
 ])
@@ -53,9 +55,11 @@ def main(options=None):
 
     print("Iterating over files.")
     with Pool(processes=args.nproc) as pool:
-        imap_it = pool.imap(_getDLACat, all_truths)
+        imap_it = utils.imap_balanced(
+            pool, _getDLACat, all_truths,
+            utils.get_file_sizes(all_truths), args.nproc)
 
-        for arr in imap_it:
+        for arr in utils.collect_in_order(imap_it, len(all_truths)):
             if arr is None:
                 continue
 
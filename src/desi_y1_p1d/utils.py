@@ -1,6 +1,13 @@
+import copy
+import hashlib
+import heapq
+import json
+import os
 import subprocess
 import time
 
+import numpy as np
+
 
 def execute_command(command):
     process = subprocess.run(command, shell=True, capture_output=True, text=True)
@@ -117,3 +124,258 @@ def submit_script(
 
     print(f"JobID: {jobid}")
     return jobid
+
+
+def get_file_sizes(fnames):
+    sizes = []
+    for f in fnames:
+        try:
+            sizes.append(os.path.getsize(f))
+        except OSError:
+            sizes.append(0)
+
+    return sizes
+
+
+def split_balanced(items, sizes, nchunks):
+    # Greedy largest-first partition into nchunks groups of similar total
+    # size. Returns (chunk, chunk_size) pairs, largest first.
+    nchunks = max(1, min(nchunks, len(items)))
+    order = sorted(range(len(items)), key=lambda i: sizes[i], reverse=True)
+
+    heap = [(0, j) for j in range(nchunks)]
+    chunks = [[] for _ in range(nchunks)]
+    totals = [0] * nchunks
+    for i in order:
+        total, j = heapq.heappop(heap)
+        chunks[j].append(items[i])
+        totals[j] = total + sizes[i]
+        heapq.heappush(heap, (totals[j], j))
+
+    order = sorted(range(nchunks), key=lambda j: totals[j], reverse=True)
+    return [(chunks[j], totals[j]) for j in order]
+
+
+def guided_chunks(sizes, nproc, factor=4):
+    # Groups indices sorted largest-first into chunks of about
+    # remaining size / (factor * nproc). Large items travel alone at the
+    # start, small ones at the tail are batched to cut IPC overhead.
+    order = sorted(range(len(sizes)), key=lambda i: sizes[i], reverse=True)
+    remaining = sum(sizes)
+    chunks, current, current_size = [], [], 0
+    target = remaining / (factor * nproc)
+
+    for i in order:
+        current.append(i)
+        current_size += sizes[i]
+        if current_size >= target:
+            chunks.append(current)
+            remaining -= current_size
+            target = remaining / (factor * nproc)
+            current, current_size = [], 0
+
+    if current:
+        chunks.append(current)
+
+    return chunks
+
+
+class _TimedChunkRunner():
+    # Every item gets a fresh copy of func, so state kept by callable
+    # objects (e.g. accumulators that return self) never depends on how
+    # guided_chunks groups the items.
+    def __init__(self, func, star=False):
+        self.func = func
+        self.star = star
+
+    def _run(self, x):
+        func = copy.deepcopy(self.func)
+        if self.star:
+            return func(*x)
+        return func(x)
+
+    def __call__(self, chunk):
+        t0 = time.perf_counter()
+        results = [(i, self._run(x)) for i, x in chunk]
+
+        return os.getpid(), time.perf_counter() - t0, results
+
+
+def print_worker_busy_times(busy_times, wall_time):
+    if not busy_times:
+        return
+
+    busy = list(busy_times.values())
+    mean_busy = sum(busy) / len(busy)
+    print(f"Worker busy times over {len(busy)} workers in {wall_time:.1f} s "
+          f"wall: min {min(busy):.1f} s, mean {mean_busy:.1f} s, "
+          f"max {max(busy):.1f} s. Load balance (mean/max): "
+          f"{mean_busy / max(max(busy), 1e-12):.2f}", flush=True)
+
+
+def imap_balanced(pool, func, items, sizes, nproc, star=False, factor=4):
+    # Yields (index in items, result) pairs in completion order and prints
+    # per-worker busy times once all chunks are done. func is copied for
+    # every item, see _TimedChunkRunner.
+    if nproc is None:
+        nproc = os.cpu_count()
+
+    chunks = [[(i, items[i]) for i in chunk]
+              for chunk in guided_chunks(sizes, nproc, factor)]
+    busy_times = {}
+    t0 = time.perf_counter()
+    imap_it = pool.imap_unordered(_TimedChunkRunner(func, star), chunks)
+    for pid, busy, results in imap_it:
+        busy_times[pid] = busy_times.get(pid, 0) + busy
+        yield from results
+
+    print_worker_busy_times(busy_times, time.perf_counter() - t0)
+
+
+def collect_in_order(indexed_results, nitems):
+    # Puts (index, result) pairs of imap_balanced back in input order, so
+    # outputs are the same as a plain Pool.imap over the items. Raises if
+    # an item is missing or returned twice.
+    results = [None] * nitems
+    seen = [False] * nitems
+    for i, result in indexed_results:
+        if seen[i]:
+            raise ValueError(f"Item {i} is returned more than once.")
+        seen[i] = True
+        results[i] = result
+
+    if not all(seen):
+        raise ValueError(
+            f"{seen.count(False)} of {nitems} items are not returned.")
+
+    return results
+
+
+def float32_difference_report(label, ref, test):
+    # Summary of how far a float32 result is from its float64 reference.
+    ref = np.asarray(ref, dtype=np.float64)
+    test = np.asarray(test, dtype=np.float64)
+    finite = np.isfinite(ref) & np.isfinite(test)
+    nmismatch = np.count_nonzero(np.isfinite(ref) != np.isfinite(test))
+
+    absdiff = np.abs(test - ref)[finite]
+    scale = np.abs(ref)[finite]
+    reldiff = absdiff / np.where(scale > 0, scale, 1)
+    if absdiff.size == 0:
+        absdiff = reldiff = np.zeros(1)
+
+    return (f"float32 vs float64 {label}: max abs diff {absdiff.max():.3e}, "
+            f"max rel diff {reldiff.max():.3e}, rms rel diff "
+            f"{np.sqrt(np.mean(reldiff**2)):.3e} over {finite.sum()} values,"
+            f" {nmismatch} non-finite mismatches.")
+
+
+def file_checksum(fname, blocksize=16 * 1024 * 1024):
+    h = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+
+    return h.hexdigest()
+
+
+def describe_input_files(fnames, checksum=False):
+    # Size and modification time of each file keyed by its absolute path.
+    # Recorded in completion markers. Reading whole files for the checksum
+    # is only worth it when the markers are checked.
+    inputs = {}
+    for fname in fnames:
+        fname = os.path.abspath(fname)
+        st = os.stat(fname)
+        inputs[fname] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+        if checksum:
+            inputs[fname]["sha256"] = file_checksum(fname)
+
+    return inputs
+
+
+def _get_marker_fname(output):
+    return f"{output}.done"
+
+
+def write_completion_marker(output, inputs, options=None):
+    """Marks output as complete.
+
+    The marker is a JSON file next to output that records the inputs and
+    the options the output depends on. Remove the old marker with
+    remove_completion_marker before rebuilding output and write the new one
+    after output is in place, so a run killed in between only redoes this
+    output.
+
+    Args:
+        output (str): Output file.
+        inputs (dict): Input files as returned by describe_input_files.
+        options (dict): Options that change the output.
+    """
+    marker = {
+        "output": os.path.basename(output), "inputs": inputs,
+        "options": options or {}}
+    fmarker = _get_marker_fname(output)
+    with open(f"{fmarker}.tmp", 'w') as f:
+        json.dump(marker, f, indent=1)
+    os.replace(f"{fmarker}.tmp", fmarker)
+
+
+def remove_completion_marker(output):
+    # Called before output is rebuilt, so a marker of a previous run never
+    # vouches for a partially or differently built output.
+    try:
+        os.remove(_get_marker_fname(output))
+    except FileNotFoundError:
+        pass
+
+
+def is_output_complete(output, input_fnames, options=None):
+    """Checks the completion marker of output against the current inputs.
+
+    Inputs with the recorded size and modification time are trusted. If
+    only the modification time differs, the checksum is compared instead
+    when the marker has one.
+
+    Args:
+        output (str): Output file.
+        input_fnames (list(str)): Input files.
+        options (dict): Options that change the output.
+
+    Returns:
+        bool: True if output exists and is up to date.
+    """
+    fmarker = _get_marker_fname(output)
+    if not (os.path.exists(output) and os.path.exists(fmarker)):
+        return False
+
+    try:
+        with open(fmarker) as f:
+            marker = json.load(f)
+    except (OSError, ValueError):
+        return False
+
+    # Round trip through JSON so that tuples compare equal to lists
+    if marker.get("options") != json.loads(json.dumps(options or {})):
+        return False
+
+    recorded = marker.get("inputs", {})
+    input_fnames = [os.path.abspath(fname) for fname in input_fnames]
+    if set(recorded) != set(input_fnames):
+        return False
+
+    for fname in input_fnames:
+        try:
+            st = os.stat(fname)
+        except OSError:
+            return False
+
+        rec = recorded[fname]
+        if st.st_size != rec["size"]:
+            return False
+        if st.st_mtime_ns == rec["mtime_ns"]:
+            continue
+        if "sha256" not in rec or file_checksum(fname) != rec["sha256"]:
+            return False
+
+    return True